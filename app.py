@@ -1,12 +1,11 @@
 import os
+import uuid
 import asyncio
 import argparse
 import logging
-from utility.audio.audio_generator import generate_audio
-from utility.captions.timed_captions_generator import generate_timed_captions
-from utility.video.background_video_generator import generate_video_url
-from utility.render.render_engine import get_output_media
-from utility.video.video_search_query_generator import getVideoSearchQueriesTimed, merge_empty_intervals
+from filelock import FileLock, Timeout
+from utility.pipeline.checkpoint import PIPELINE_STAGES
+from utility.pipeline.pipeline import PipelineRun
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -21,45 +20,32 @@ def read_script_from_file(file_path):
         logging.error(f"Error reading script file: {file_path}")
         raise
 
-async def main(script_file, video_type):
-    SAMPLE_FILE_NAME = "audio_tts.wav"
-    VIDEO_SERVER = "pexel"
+async def main(script_file, video_type, caption_source='tts', clip_assignment='greedy', render_backend='moviepy', render_slices=1, job_dir=None, force_stages=()):
+    script_name = os.path.splitext(os.path.basename(script_file))[0]
+    job = {
+        # Every run gets a workspace of its own unless --job_dir names one to resume
+        "job_id": script_name if job_dir else f"{script_name}-{uuid.uuid4().hex[:8]}",
+        "job_dir": job_dir,
+        "script": read_script_from_file(script_file),
+        "video_type": video_type,
+        "captions": caption_source,
+        "clip_assignment": clip_assignment,
+        "render_backend": render_backend,
+        "render_slices": render_slices
+    }
+    logging.info(f"Script read from file: {job['script'][:50]}...")
 
     try:
-        # Read the script from the file
-        script = read_script_from_file(script_file)
-        logging.info(f"Script read from file: {script[:50]}...")
-
-        # Generate audio from the script
-        await generate_audio(script, SAMPLE_FILE_NAME)
-        logging.info(f"Audio generated: {SAMPLE_FILE_NAME}")
-
-        # Generate timed captions
-        timed_captions = generate_timed_captions(SAMPLE_FILE_NAME)
-        logging.info(f"Timed captions generated: {len(timed_captions)} captions")
-
-        # Generate search terms for background videos
-        search_terms = getVideoSearchQueriesTimed(script, timed_captions)
-        logging.info(f"Search terms generated: {len(search_terms) if search_terms else 0} terms")
-
-        # Generate background video URLs
-        background_video_urls = None
-        if search_terms is not None:
-            background_video_urls = generate_video_url(search_terms, VIDEO_SERVER)
-            logging.info(f"Background video URLs generated: {len(background_video_urls) if background_video_urls else 0} URLs")
-        else:
-            logging.warning("No background video search terms generated")
-
-        # Merge empty intervals in background video URLs
-        background_video_urls = merge_empty_intervals(background_video_urls)
-
-        # Generate the final video
-        if background_video_urls is not None:
-            video = get_output_media(SAMPLE_FILE_NAME, timed_captions, background_video_urls, VIDEO_SERVER)
-            logging.info(f"Output video generated: {video}")
-        else:
-            logging.warning("No video generated due to lack of background videos")
-
+        # The job's files live in its own workspace; every stage records a hash of its inputs there and
+        # is skipped when the run is resumed with --job_dir while those inputs are unchanged
+        run = PipelineRun(job, force_stages=force_stages)
+        logging.info(f"Job workspace: {run.context.workspace}")
+        # Two runs resuming the same workspace would overwrite each other's files
+        with FileLock(run.context.path("job.lock"), timeout=0):
+            return await run.run_all()
+    except Timeout:
+        logging.error(f"Another run is already using the workspace {run.context.workspace}")
+        raise
     except Exception as e:
         logging.error(f"An error occurred during video generation: {str(e)}")
         raise
@@ -68,10 +54,20 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a video from a script file.")
     parser.add_argument("script_file", type=str, help="Path to the script file (script.txt)")
     parser.add_argument("--video_type", type=str, choices=['short', 'long'], default='short', help="Type of video to generate")
+    parser.add_argument("--captions", type=str, choices=['tts', 'whisper'], default='tts', help="Time captions from TTS word boundaries or by transcribing with Whisper")
+    parser.add_argument("--clip_assignment", type=str, choices=['greedy', 'global'], default='greedy', help="Pick clips segment by segment, or solve all segments together")
+    parser.add_argument("--render_backend", type=str, choices=['moviepy', 'ffmpeg'], default='moviepy', help="Composite with MoviePy or compile the timeline into a single ffmpeg filter graph")
+    parser.add_argument("--render_slices", type=int, default=1, help="Render the MoviePy timeline as this many slices in parallel processes (0 uses every core)")
+    parser.add_argument("--job_dir", type=str, default=None, help="Directory for this job's stage artifacts; pass an earlier run's workspace to resume it (default: a new jobs/<script name>-<id>)")
+    parser.add_argument("--force-stage", "--force_stage", dest="force_stages", action="append", choices=PIPELINE_STAGES, default=[], help="Re-run this stage even if its inputs are unchanged (repeatable)")
+    parser.add_argument("--prewarm", action="store_true", help="Load the Whisper model at startup, failing if its checkpoint is not already cached")
 
     args = parser.parse_args()
 
     try:
-        asyncio.run(main(args.script_file, args.video_type))
+        if args.prewarm:
+            from utility.captions.whisper_model_registry import prewarm
+            prewarm()
+        asyncio.run(main(args.script_file, args.video_type, args.captions, args.clip_assignment, args.render_backend, args.render_slices or os.cpu_count(), args.job_dir, args.force_stages))
     except Exception as e:
         logging.error(f"Video generation failed: {str(e)}")
@@ -12,6 +12,10 @@ from openai import OpenAI
 import edge_tts
 import whisper_timestamped as whisper
 from moviepy.editor import (AudioFileClip, CompositeVideoClip, CompositeAudioClip, TextClip, VideoFileClip)
+from utility.captions.whisper_model_registry import get_model
+from utility.pipeline.job_context import JobContext
+from utility.script.llm_cache import cached_completion
+from utility.video.video_search_query_generator import MAX_QUERY_ATTEMPTS, parse_search_queries, snap_to_captions
 
 # Environment variables
 OPENAI_API_KEY = os.getenv('OPENAI_KEY')
@@ -99,15 +103,7 @@ def generate_script(topic, video_type='short'):
         """
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": topic}
-            ]
-        )
-        
-        content = response.choices[0].message.content
+        content = cached_completion(client, "gpt-4", prompt, topic, validate=lambda content: content.startswith('{') and '"script"' in content)
         print("Raw Response:", content)
         
         if not content or (not content.startswith('{') and not content.startswith('[')):
@@ -131,7 +127,7 @@ async def generate_audio(text, output_filename):
 
 # Timed captions generation
 def generate_timed_captions(audio_filename, model_size="base"):
-    WHISPER_MODEL = whisper.load_model(model_size)
+    WHISPER_MODEL = get_model(model_size)
     gen = whisper.transcribe_timestamped(WHISPER_MODEL, audio_filename, verbose=False, fp16=False)
     return get_captions_with_time(gen)
 
@@ -193,19 +189,17 @@ def get_captions_with_time(whisper_analysis, max_caption_size=15, consider_punct
 
 # Video search query generation
 def get_video_search_queries_timed(script, captions_timed):
-    end = captions_timed[-1][0][1]
     try:
-        out = [[[0,0],""]]
-        while out[-1][0][1] != end:
-            content = call_OpenAI(script, captions_timed).replace("'",'"')
+        # The intervals are snapped to the captions locally, so only an unparseable answer is retried
+        for attempt in range(MAX_QUERY_ATTEMPTS):
+            content = call_OpenAI(script, captions_timed)
             try:
-                out = json.loads(content)
-            except Exception as e:
+                out = snap_to_captions(parse_search_queries(content), captions_timed)
+                if out:
+                    return out
+            except ValueError as e:
                 print("content: \n", content, "\n\n")
                 print(e)
-                content = fix_json(content.replace("```json", "").replace("```", ""))
-                out = json.loads(content)
-        return out
     except Exception as e:
         print("error in response", e)
     return None
@@ -334,8 +328,8 @@ def get_program_path(program_name):
     program_path = search_program(program_name)
     return program_path
 
-def get_output_media(audio_file_path, timed_captions, background_video_data, video_server):
-    OUTPUT_FILE_NAME = "rendered_video.mp4"
+def get_output_media(audio_file_path, timed_captions, background_video_data, video_server, context=None):
+    OUTPUT_FILE_NAME = context.output_file if context else "rendered_video.mp4"
     magick_path = get_program_path("magick")
     print(magick_path)
     if magick_path:
@@ -386,10 +380,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a video from a topic.")
     parser.add_argument("topic", type=str, help="The topic for the video")
     parser.add_argument("--video_type", type=str, choices=['short', 'long'], default='short', help="Type of video to generate")
+    parser.add_argument("--job_dir", type=str, default=None, help="Workspace for this job's files (default: jobs/<timestamp>)")
 
     args = parser.parse_args()
     SAMPLE_TOPIC = args.topic
-    SAMPLE_FILE_NAME = "audio_tts.wav"
+    context = JobContext(datetime.now().strftime("%Y%m%d_%H%M%S_%f"), args.job_dir)
+    SAMPLE_FILE_NAME = context.audio_file
     VIDEO_SERVER = "pexel"
 
     # Generate the script based on the video type
@@ -414,7 +410,7 @@ if __name__ == "__main__":
     background_video_urls = merge_empty_intervals(background_video_urls)
 
     if background_video_urls is not None:
-        video = get_output_media(SAMPLE_FILE_NAME, timed_captions, background_video_urls, VIDEO_SERVER)
+        video = get_output_media(SAMPLE_FILE_NAME, timed_captions, background_video_urls, VIDEO_SERVER, context)
         print(video)
     else:
         print("No video")
@@ -0,0 +1,58 @@
+import json
+import asyncio
+import argparse
+import logging
+from utility.pipeline.checkpoint import PIPELINE_STAGES
+from utility.pipeline.pipeline import StagePools, run_job
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def read_jobs(jobs_file):
+    jobs = []
+    with open(jobs_file, 'r') as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            job.setdefault("job_id", f"job-{line_number:04d}")
+            jobs.append(job)
+    return jobs
+
+async def run_batch(jobs_file, results_file, max_jobs=4, io_workers=4, whisper_workers=1, render_workers=None, force_stages=()):
+    jobs = read_jobs(jobs_file)
+    logging.info(f"Running {len(jobs)} jobs from {jobs_file}")
+    pools = StagePools(io_workers, whisper_workers, render_workers)
+    # Admitting a few more jobs than the render pool holds lets later jobs' network stages run
+    # while earlier jobs render, without every job's intermediate state being in flight at once
+    admission = asyncio.Semaphore(max_jobs)
+
+    async def admit(job):
+        async with admission:
+            return await run_job(job, pools, force_stages)
+
+    failed = 0
+    try:
+        with open(results_file, 'w') as results:
+            for future in asyncio.as_completed([admit(job) for job in jobs]):
+                result = await future
+                failed += result["status"] != "ok"
+                results.write(json.dumps(result) + '\n')
+                results.flush()
+                logging.info(f"Job {result['job_id']} {result['status']} in {result['seconds']}s")
+    finally:
+        pools.shutdown()
+    logging.info(f"Batch finished: {len(jobs) - failed} ok, {failed} failed, results in {results_file}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate videos for every job in a JSONL file.")
+    parser.add_argument("jobs_file", type=str, help="JSONL file with one job per line: {\"job_id\", and one of \"script\", \"script_file\" or \"topic\"}")
+    parser.add_argument("--results", type=str, default="results.jsonl", help="Where to write one result line per job")
+    parser.add_argument("--max_jobs", type=int, default=4, help="Jobs in flight at once")
+    parser.add_argument("--io_workers", type=int, default=4, help="Concurrent calls per network stage (LLM, TTS, Pexels, downloads)")
+    parser.add_argument("--whisper_workers", type=int, default=1, help="Processes transcribing with Whisper")
+    parser.add_argument("--render_workers", type=int, default=None, help="Processes rendering videos (default: half the cores)")
+    parser.add_argument("--force-stage", "--force_stage", dest="force_stages", action="append", choices=PIPELINE_STAGES, default=[], help="Re-run this stage for every job even if its inputs are unchanged (repeatable)")
+
+    args = parser.parse_args()
+    asyncio.run(run_batch(args.jobs_file, args.results, args.max_jobs, args.io_workers, args.whisper_workers,
+                          args.render_workers, args.force_stages))
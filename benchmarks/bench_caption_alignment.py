@@ -0,0 +1,49 @@
+import argparse
+import random
+import timeit
+from utility.captions.timed_captions_generator import (getCaptionsWithTime, getTimestampMapping,
+                                                        interpolateTimeFromDict, splitWordsBySize, cleanWord)
+
+VOCABULARY = ["the", "ancient", "desert", "facility", "rumors", "suggest", "hidden", "hangars", "alien",
+              "technology", "U.S.", "government's", "classified", "testing", "range", "mysteries,", "secrets."]
+
+def make_transcript(word_count, seed=0):
+    rng = random.Random(seed)
+    words = []
+    t = 0.0
+    for _ in range(word_count):
+        t += rng.uniform(0.15, 0.6)
+        words.append({'text': rng.choice(VOCABULARY), 'start': t - 0.1, 'end': round(t, 2)})
+    segments = [{'words': words[i:i + 20]} for i in range(0, len(words), 20)]
+    return {'text': ' ' + ' '.join(word['text'] for word in words), 'segments': segments}
+
+def getCaptionsWithTimeLinear(whisper_analysis, maxCaptionSize=15):
+    # The pre-index implementation, kept here as the reference for output and timing
+    wordLocationToTime = getTimestampMapping(whisper_analysis)
+    position = 0
+    start_time = 0
+    CaptionsPairs = []
+    words = [cleanWord(word) for word in splitWordsBySize(whisper_analysis['text'].split(), maxCaptionSize)]
+    for word in words:
+        position += len(word) + 1
+        end_time = interpolateTimeFromDict(position, wordLocationToTime)
+        if end_time and word:
+            CaptionsPairs.append(((start_time, end_time), word))
+            start_time = end_time
+    return CaptionsPairs
+
+def run(label, word_count, repeat):
+    transcript = make_transcript(word_count)
+    assert getCaptionsWithTime(transcript) == getCaptionsWithTimeLinear(transcript), "indexed output differs"
+    linear = min(timeit.repeat(lambda: getCaptionsWithTimeLinear(transcript), number=1, repeat=repeat))
+    indexed = min(timeit.repeat(lambda: getCaptionsWithTime(transcript), number=1, repeat=repeat))
+    print(f"{label:<6} {word_count:>6} words  linear {linear * 1000:9.2f} ms  indexed {indexed * 1000:8.2f} ms  speedup {linear / indexed:6.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark caption timing on short and long transcripts.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions per case")
+    args = parser.parse_args()
+
+    run("short", 140, args.repeat)
+    run("long", 1400, args.repeat)
+    run("xlong", 5000, args.repeat)
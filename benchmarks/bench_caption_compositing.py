@@ -0,0 +1,60 @@
+import argparse
+import time
+import numpy as np
+from moviepy.editor import ColorClip, CompositeVideoClip, ImageClip
+from utility.render.caption_style import VIDEO_SIZE, VIDEO_FPS
+from utility.render.caption_overlay import CaptionOverlay
+
+SPRITE_SIZE = (420, 60)
+
+def make_caption_layers(caption_count, caption_duration):
+    rng = np.random.default_rng(0)
+    width, height = VIDEO_SIZE
+    sprite_width, sprite_height = SPRITE_SIZE
+    x, y = (width - sprite_width) // 2, (height - sprite_height) // 2
+    layers = []
+    for i in range(caption_count):
+        rgb = np.full((sprite_height, sprite_width, 3), 255, dtype=np.uint8)
+        alpha = (rng.random((sprite_height, sprite_width)) > 0.6).astype(np.float64)
+        layers.append((i * caption_duration, (i + 1) * caption_duration, x, y, rgb, alpha))
+    return layers
+
+def full_frame_clips(layers):
+    # The original path: one frame-sized image and mask per caption, composited as clip layers
+    width, height = VIDEO_SIZE
+    clips = []
+    for start, end, x, y, rgb, alpha in layers:
+        frame_rgb = np.zeros((height, width, 3), dtype=np.uint8)
+        frame_alpha = np.zeros((height, width))
+        frame_rgb[y:y + rgb.shape[0], x:x + rgb.shape[1]] = rgb
+        frame_alpha[y:y + rgb.shape[0], x:x + rgb.shape[1]] = alpha
+        clips.append(ImageClip(frame_rgb).set_mask(ImageClip(frame_alpha, ismask=True)).set_start(start).set_end(end))
+    return clips
+
+def measure_fps(clip, frame_count):
+    start = time.perf_counter()
+    for i in range(frame_count):
+        clip.get_frame(i / VIDEO_FPS)
+    return frame_count / (time.perf_counter() - start)
+
+def run(caption_count, frame_count):
+    caption_duration = frame_count / VIDEO_FPS / caption_count
+    layers = make_caption_layers(caption_count, caption_duration)
+    duration = caption_count * caption_duration
+    background = ColorClip(VIDEO_SIZE, color=(30, 60, 90), duration=duration)
+
+    before = CompositeVideoClip([background] + full_frame_clips(layers), size=VIDEO_SIZE).set_duration(duration)
+    after = CaptionOverlay(layers).apply(CompositeVideoClip([background], size=VIDEO_SIZE).set_duration(duration))
+
+    before_fps = measure_fps(before, frame_count)
+    after_fps = measure_fps(after, frame_count)
+    print(f"{caption_count:>5} captions  full-frame layers {before_fps:7.1f} fps/core  overlay {after_fps:7.1f} fps/core  speedup {after_fps / before_fps:5.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark single-core caption compositing throughput.")
+    parser.add_argument("--frames", type=int, default=150, help="Frames to composite per case")
+    args = parser.parse_args()
+
+    # Run pinned to one core (e.g. taskset -c 0) for per-core numbers
+    for caption_count in (10, 50, 200):
+        run(caption_count, args.frames)
@@ -0,0 +1,70 @@
+import argparse
+import time
+import random
+import asyncio
+import utility.pipeline.media_stream as media_stream
+from utility.video.video_search_query_generator import merge_empty_intervals
+
+# Simulated latencies, in seconds, for one segment's Pexels search, clip download and preparation
+SEARCH_SECONDS = 0.05
+DOWNLOAD_SECONDS = 0.12
+PREP_SECONDS = 0.06
+
+def make_segments(segment_count, missing_rate, seed=0):
+    rng = random.Random(seed)
+    segments = [[[i * 3.0, (i + 1) * 3.0], None if rng.random() < missing_rate else f"https://example.com/clip{i}.mp4"]
+                for i in range(segment_count)]
+    return [[interval, [f"query {i}"]] for i, (interval, _) in enumerate(segments)], segments
+
+async def fake_search(timed_video_urls, on_url=None):
+    # Selection walks the segments in order, waiting on each segment's search in turn
+    for item in timed_video_urls:
+        await asyncio.sleep(SEARCH_SECONDS)
+        if on_url:
+            await on_url(item)
+    return timed_video_urls
+
+def fake_download(url, duration):
+    time.sleep(DOWNLOAD_SECONDS)
+    return url
+
+def fake_prepare(source_filename, holder=None):
+    time.sleep(PREP_SECONDS)
+    return source_filename
+
+async def run_sequential(timed_video_urls):
+    # The stage-by-stage path: every search, then every download, then every preparation
+    merged = merge_empty_intervals(await fake_search(timed_video_urls))
+    sources = await asyncio.gather(*(asyncio.to_thread(fake_download, url, t2 - t1) for (t1, t2), url in merged if url))
+    await asyncio.gather(*(asyncio.to_thread(fake_prepare, source) for source in sources))
+    return merged
+
+def run(label, segment_count, missing_rate):
+    timed_video_searches, timed_video_urls = make_segments(segment_count, missing_rate)
+
+    async def generate_video_url_async(timed_video_searches, video_server, max_concurrent_searches, assignment, context, client, on_url):
+        return await fake_search(timed_video_urls, on_url)
+
+    media_stream.generate_video_url_async = generate_video_url_async
+    media_stream.get_clip_media = fake_download
+    media_stream.prepare_clip = fake_prepare
+
+    started = time.perf_counter()
+    expected = asyncio.run(run_sequential(timed_video_urls))
+    sequential = time.perf_counter() - started
+
+    started = time.perf_counter()
+    merged, report = asyncio.run(media_stream.fetch_background_media_async(timed_video_searches, "pexel"))
+    overlapped = time.perf_counter() - started
+    assert merged == expected, "overlapped pipeline chose different clips"
+
+    print(f"{label:<6} {segment_count:>4} segments  sequential {sequential:6.2f} s  overlapped {overlapped:6.2f} s  "
+          f"speedup {sequential / overlapped:4.1f}x  overlap {report['overlapped_fraction']:.0%} of wall time")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark overlapped clip search, download and preparation with simulated latencies.")
+    parser.add_argument("--missing_rate", type=float, default=0.1, help="Share of segments without a clip")
+    args = parser.parse_args()
+
+    run("short", 20, args.missing_rate)
+    run("long", 150, args.missing_rate)
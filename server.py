@@ -0,0 +1,226 @@
+import re
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import logging
+from aiohttp import web
+from utility.pipeline.checkpoint import PIPELINE_STAGES
+from utility.pipeline.pipeline import ServicePools, run_job
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+FINISHED_STATUSES = ("ok", "failed", "cancelled")
+# script_file and job_dir name paths on this host, so HTTP clients may not set them
+SCRIPT_SOURCES = ("script", "topic")
+LOCAL_ONLY_KEYS = ("script_file", "job_dir")
+# The job id names the job's workspace directory under the jobs root
+JOB_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+# Older events are dropped past this; a listener that falls further behind skips them
+MAX_JOB_EVENTS = 500
+# Finished jobs stay listed for this long, and only this many of them at once
+FINISHED_JOB_TTL = 3600
+MAX_FINISHED_JOBS = 1000
+
+class Job:
+    def __init__(self, spec):
+        self.spec = spec
+        self.job_id = spec["job_id"]
+        self.status = "queued"
+        self.result = None
+        self.task = None
+        self.finished_at = None
+        self.events = []
+        # Events ever published, so listeners can keep their place after old events are dropped
+        self.event_count = 0
+        # Replaced on every publish, so a listener waits on the one current when it last caught up
+        self.updated = asyncio.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def publish(self, event):
+        self.events.append({"job_id": self.job_id, "time": round(time.time(), 3), **event})
+        self.event_count += 1
+        del self.events[:-MAX_JOB_EVENTS]
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    def set_status(self, status):
+        self.status = status
+        if self.finished:
+            self.finished_at = time.time()
+        self.publish({"event": "status", "status": status})
+
+    def publish_render_progress(self, phase, index, total):
+        self.publish({"event": "render_progress", "phase": phase, "index": index, "total": total})
+
+    def events_since(self, sent):
+        first = self.event_count - len(self.events)
+        return self.events[max(0, sent - first):]
+
+    def describe(self):
+        return {"job_id": self.job_id, "status": self.status, "result": self.result}
+
+class JobService:
+    def __init__(self, pools, max_jobs=2, max_queued=100):
+        self.pools = pools
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.workers = []
+
+    def start(self):
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.max_jobs)]
+
+    async def stop(self):
+        for job in self.jobs.values():
+            if job.task and not job.task.done():
+                job.task.cancel()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        await self.pools.close()
+
+    def prune_finished(self):
+        finished = sorted((job for job in self.jobs.values() if job.finished), key=lambda job: job.finished_at)
+        expired = time.time() - FINISHED_JOB_TTL
+        for i, job in enumerate(finished):
+            if job.finished_at < expired or i < len(finished) - MAX_FINISHED_JOBS:
+                del self.jobs[job.job_id]
+
+    def submit(self, spec):
+        self.prune_finished()
+        job = Job(spec)
+        # Raises asyncio.QueueFull, which the API turns into back-pressure for the caller
+        self.queue.put_nowait(job)
+        self.jobs[job.job_id] = job
+        job.set_status("queued")
+        return job
+
+    def cancel(self, job):
+        if job.status == "queued":
+            job.set_status("cancelled")
+        elif job.task and not job.task.done():
+            job.task.cancel()
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if job.status == "cancelled":
+                    continue
+                job.set_status("running")
+                job.task = asyncio.create_task(run_job(
+                    job.spec, self.pools.for_job(job.publish_render_progress),
+                    job.spec.get("force_stages", ()), on_event=job.publish))
+                try:
+                    job.result = await job.task
+                    job.set_status(job.result["status"])
+                except asyncio.CancelledError:
+                    # Only swallow the job's own cancellation, not the worker being shut down
+                    if not job.task.cancelled():
+                        raise
+                    job.set_status("cancelled")
+            except Exception as e:
+                logging.error(f"Job {job.job_id} crashed: {str(e)}")
+                job.set_status("failed")
+            finally:
+                self.queue.task_done()
+
+def get_job(request):
+    job = request.app["service"].jobs.get(request.match_info["job_id"])
+    if job is None:
+        raise web.HTTPNotFound(text=json.dumps({"error": "Unknown job"}), content_type="application/json")
+    return job
+
+async def submit_job(request):
+    service = request.app["service"]
+    try:
+        spec = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text=json.dumps({"error": "Body must be a JSON object"}), content_type="application/json")
+    if not isinstance(spec, dict) or not any(source in spec for source in SCRIPT_SOURCES):
+        raise web.HTTPBadRequest(text=json.dumps({"error": f"Job needs one of {', '.join(SCRIPT_SOURCES)}"}), content_type="application/json")
+    if any(key in spec for key in LOCAL_ONLY_KEYS):
+        raise web.HTTPBadRequest(text=json.dumps({"error": f"{', '.join(LOCAL_ONLY_KEYS)} cannot be set over HTTP"}), content_type="application/json")
+    if "job_id" in spec and not (isinstance(spec["job_id"], str) and JOB_ID_PATTERN.fullmatch(spec["job_id"])):
+        raise web.HTTPBadRequest(text=json.dumps({"error": "job_id must be 1-64 letters, digits, '_', '.' or '-'"}), content_type="application/json")
+    if any(stage not in PIPELINE_STAGES for stage in spec.get("force_stages", [])):
+        raise web.HTTPBadRequest(text=json.dumps({"error": f"force_stages must be among {', '.join(PIPELINE_STAGES)}"}), content_type="application/json")
+
+    spec.setdefault("job_id", uuid.uuid4().hex[:12])
+    existing = service.jobs.get(spec["job_id"])
+    if existing and not existing.finished:
+        raise web.HTTPConflict(text=json.dumps({"error": "Job is already queued or running"}), content_type="application/json")
+    try:
+        job = service.submit(spec)
+    except asyncio.QueueFull:
+        raise web.HTTPTooManyRequests(text=json.dumps({"error": "Job queue is full"}), content_type="application/json",
+                                      headers={"Retry-After": "30"})
+    return web.json_response(job.describe(), status=202)
+
+async def list_jobs(request):
+    return web.json_response([job.describe() for job in request.app["service"].jobs.values()])
+
+async def describe_job(request):
+    return web.json_response(get_job(request).describe())
+
+async def cancel_job(request):
+    job = get_job(request)
+    request.app["service"].cancel(job)
+    return web.json_response(job.describe(), status=202)
+
+async def stream_events(request):
+    # Server-sent events: replay everything the job has published so far, then follow it live
+    job = get_job(request)
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    sent = 0
+    while True:
+        updated = job.updated
+        for event in job.events_since(sent):
+            await response.write(f"event: {event['event']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+        sent = job.event_count
+        if job.finished:
+            break
+        await updated.wait()
+    return response
+
+def create_app(max_jobs=2, max_queued=100, io_workers=4, render_workers=None, prewarm=False):
+    app = web.Application()
+
+    async def on_startup(app):
+        if prewarm:
+            from utility.captions.whisper_model_registry import prewarm as prewarm_whisper
+            await asyncio.to_thread(prewarm_whisper)
+        app["service"] = JobService(ServicePools(io_workers, render_workers), max_jobs, max_queued)
+        app["service"].start()
+
+    async def on_cleanup(app):
+        await app["service"].stop()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post("/jobs", submit_job)
+    app.router.add_get("/jobs", list_jobs)
+    app.router.add_get("/jobs/{job_id}", describe_job)
+    app.router.add_delete("/jobs/{job_id}", cancel_job)
+    app.router.add_get("/jobs/{job_id}/events", stream_events)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve video generation jobs over a local HTTP API.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--max_jobs", type=int, default=2, help="Jobs running at once")
+    parser.add_argument("--max_queued", type=int, default=100, help="Jobs waiting before new submissions are refused")
+    parser.add_argument("--io_workers", type=int, default=4, help="Concurrent calls per network stage (LLM, TTS, Pexels, downloads)")
+    parser.add_argument("--render_workers", type=int, default=None, help="Render subprocesses at once (default: half the cores)")
+    parser.add_argument("--prewarm", action="store_true", help="Load the Whisper model at startup, failing if its checkpoint is not already cached")
+
+    args = parser.parse_args()
+    web.run_app(create_app(args.max_jobs, args.max_queued, args.io_workers, args.render_workers, args.prewarm),
+                host=args.host, port=args.port)
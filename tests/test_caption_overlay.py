@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+drawing = pytest.importorskip("moviepy.video.tools.drawing")
+from utility.render.caption_overlay import CaptionOverlay
+
+FRAME_SIZE = (320, 180)
+
+def make_layers(count, rng):
+    width, height = FRAME_SIZE
+    layers = []
+    for _ in range(count):
+        sprite_height, sprite_width = rng.integers(10, 80), rng.integers(20, 200)
+        # Positions reach past every edge, so some sprites are only partly on screen
+        x, y = rng.integers(-sprite_width // 2, width), rng.integers(-sprite_height // 2, height)
+        start = rng.uniform(0, 10)
+        rgb = rng.integers(0, 256, (sprite_height, sprite_width, 3), dtype=np.uint8)
+        alpha = rng.integers(0, 256, (sprite_height, sprite_width)) / 255.0
+        layers.append((start, start + rng.uniform(0.5, 5), int(x), int(y), rgb, alpha))
+    return sorted(layers, key=lambda layer: layer[0])
+
+def reference_blit(frame, layers, t):
+    # MoviePy's compositing: one blit per playing layer, in order, each rounded back to uint8
+    for start, end, x, y, rgb, alpha in layers:
+        if start <= t < end:
+            frame = drawing.blit(rgb, frame, pos=[x, y], mask=alpha)
+    return frame
+
+def test_blend_matches_moviepy_blit():
+    rng = np.random.default_rng(0)
+    layers = make_layers(50, rng)
+    overlay = CaptionOverlay(layers, frame_size=FRAME_SIZE)
+    width, height = FRAME_SIZE
+    for t in rng.uniform(0, 12, 200):
+        frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        expected = reference_blit(frame.copy(), layers, t)
+        assert np.array_equal(overlay.blend(frame.copy(), t), expected)
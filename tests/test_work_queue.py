@@ -0,0 +1,15 @@
+from utility.pipeline.work_queue import WorkQueue, MAX_ATTEMPTS
+
+def test_claim_skips_exhausted_row(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite3"))
+    queue.submit({"job_id": "a"})
+    # Every lease on job a expires at once, as if each worker died mid-stage
+    for attempt in range(MAX_ATTEMPTS):
+        assert queue.claim("worker", lease_seconds=-1)["job_id"] == "a"
+    queue.submit({"job_id": "b"})
+
+    task = queue.claim("worker")
+
+    assert task is not None and task["job_id"] == "b"
+    assert queue.job_status("a")["script"]["status"] == "failed"
+    assert queue.claim("worker") is None
@@ -1,11 +1,165 @@
+import os
+import re
+import json
+import math
+import wave
+import asyncio
+import hashlib
+import subprocess
 import edge_tts
 import logging
+from utility.utils import DIRECTORY_CACHE, write_file_atomic
+from utility.render.ffmpeg_utils import get_ffmpeg_binary
 
-async def generate_audio(text, output_filename):
+VOICE = "en-AU-WilliamNeural"
+RATE = "+0%"
+# edge-tts reports WordBoundary offsets and durations in 100ns ticks
+TICKS_PER_SECOND = 10_000_000
+# edge-tts streams audio-24khz-48kbitrate-mono-mp3; chunks are decoded to 16-bit PCM at that rate and joined
+SAMPLE_RATE = 24000
+SAMPLE_WIDTH = 2
+# Kept around a sentence's first and last word when its silence is trimmed, so onsets and decays survive;
+# it also covers the MP3 decoder delay, which puts decoded speech a few tens of ms after the word offsets
+EDGE_PADDING = 0.1
+MAX_CONCURRENT_SYNTHESIS = 4
+MAX_RETRIES = 3
+RETRY_DELAY = 2
+DIRECTORY_CACHE_TTS = os.path.join(DIRECTORY_CACHE, "tts")
+
+def word_boundary_to_word(message):
+    start = message["offset"] / TICKS_PER_SECOND
+    return {
+        "text": message["text"],
+        "start": start,
+        "end": start + message["duration"] / TICKS_PER_SECOND
+    }
+
+def split_sentences(text):
+    return [sentence for sentence in re.split(r'(?<=[.!?])\s+', text.strip()) if sentence]
+
+def get_chunk_cache_path(text, voice, rate):
+    key = hashlib.sha256(json.dumps([text, voice, rate]).encode("utf-8")).hexdigest()
+    return os.path.join(DIRECTORY_CACHE_TTS, key)
+
+def load_cached_chunk(cache_path):
+    try:
+        with open(cache_path + ".mp3", "rb") as audio_file:
+            audio = audio_file.read()
+        with open(cache_path + ".json") as words_file:
+            words = json.load(words_file)
+        return audio, words
+    except (IOError, ValueError):
+        return None
+
+async def stream_chunk(text, voice, rate):
+    communicate = edge_tts.Communicate(text, voice, rate=rate)
+    audio = bytearray()
+    words = []
+    async for message in communicate.stream():
+        if message["type"] == "audio":
+            audio.extend(message["data"])
+        elif message["type"] == "WordBoundary":
+            words.append(word_boundary_to_word(message))
+    return bytes(audio), words
+
+async def synthesize_chunk(text, semaphore, voice=VOICE, rate=RATE):
+    cache_path = get_chunk_cache_path(text, voice, rate)
+    cached = load_cached_chunk(cache_path)
+    if cached is not None:
+        return cached
+
+    async with semaphore:
+        for attempt in range(MAX_RETRIES):
+            try:
+                audio, words = await stream_chunk(text, voice, rate)
+                break
+            except Exception as e:
+                logging.error(f"Error synthesizing chunk (attempt {attempt + 1}/{MAX_RETRIES}): {str(e)}")
+                if attempt < MAX_RETRIES - 1:
+                    await asyncio.sleep(RETRY_DELAY)
+                else:
+                    raise
+
+    # The JSON sidecar is written last, so a chunk only counts as cached once both files exist
+    write_file_atomic(cache_path + ".mp3", audio)
+    write_file_atomic(cache_path + ".json", json.dumps(words))
+    return audio, words
+
+def decode_chunk(audio):
+    command = [get_ffmpeg_binary(), "-hide_banner", "-loglevel", "error", "-f", "mp3", "-i", "pipe:0",
+               "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"]
+    result = subprocess.run(command, input=audio, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Error decoding speech chunk: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+def trim_chunk(pcm, words):
+    # Every response carries its own leading and trailing silence, which would put a pause at every
+    # sentence boundary; keep only the span from the first word to the last. Returns the trimmed
+    # samples and the seconds cut from the front.
+    if not words:
+        return pcm, 0.0
+    sample_count = len(pcm) // SAMPLE_WIDTH
+    start = max(0, int((words[0]["start"] - EDGE_PADDING) * SAMPLE_RATE))
+    end = min(sample_count, math.ceil((words[-1]["end"] + EDGE_PADDING) * SAMPLE_RATE))
+    return pcm[start * SAMPLE_WIDTH:max(start, end) * SAMPLE_WIDTH], start / SAMPLE_RATE
+
+def stitch_chunks(chunks, output_filename):
+    # Decodes every chunk and joins the trimmed samples into one WAV file, so there are no MP3
+    # frame or silence gaps at the joins; word offsets follow from the trimmed lengths
+    word_boundaries = []
+    chunk_start = 0.0
+    with wave.open(output_filename, "wb") as audio_file:
+        audio_file.setnchannels(1)
+        audio_file.setsampwidth(SAMPLE_WIDTH)
+        audio_file.setframerate(SAMPLE_RATE)
+        for audio, words in chunks:
+            pcm, trimmed_seconds = trim_chunk(decode_chunk(audio), words)
+            audio_file.writeframes(pcm)
+            for word in words:
+                word_boundaries.append({
+                    "text": word["text"],
+                    "start": chunk_start + word["start"] - trimmed_seconds,
+                    "end": chunk_start + word["end"] - trimmed_seconds
+                })
+            chunk_start += len(pcm) / (SAMPLE_WIDTH * SAMPLE_RATE)
+    return word_boundaries
+
+async def generate_audio(text, output_filename, voice=VOICE, rate=RATE):
+    try:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_SYNTHESIS)
+        sentences = split_sentences(text)
+        chunks = await asyncio.gather(*(synthesize_chunk(sentence, semaphore, voice, rate) for sentence in sentences))
+        # Decoding runs ffmpeg once per chunk, so it stays off the event loop
+        word_boundaries = await asyncio.to_thread(stitch_chunks, chunks, output_filename)
+        logging.info(f"Audio generated successfully: {output_filename} ({len(sentences)} chunks, {len(word_boundaries)} word boundaries)")
+        return word_boundaries
+    except Exception as e:
+        logging.error(f"Error generating audio: {str(e)}")
+        raise
+
+async def synthesize_stream(sentences, voice=VOICE, rate=RATE):
+    # Starts each sentence's synthesis as soon as the async iterable hands it over, and returns the
+    # chunks in sentence order once the iterable is exhausted
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SYNTHESIS)
+    tasks = []
+    try:
+        async for sentence in sentences:
+            tasks.append(asyncio.create_task(synthesize_chunk(sentence, semaphore, voice, rate)))
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def generate_audio_streamed(sentences, output_filename, voice=VOICE, rate=RATE):
+    # Same chunks, cache and stitching as generate_audio, so the result matches it byte for byte
+    # when the sentences are split_sentences() of the same script
     try:
-        communicate = edge_tts.Communicate(text, "en-AU-WilliamNeural")
-        await communicate.save(output_filename)
-        logging.info(f"Audio generated successfully: {output_filename}")
+        chunks = await synthesize_stream(sentences, voice, rate)
+        word_boundaries = await asyncio.to_thread(stitch_chunks, chunks, output_filename)
+        logging.info(f"Audio generated successfully: {output_filename} ({len(chunks)} streamed chunks, {len(word_boundaries)} word boundaries)")
+        return word_boundaries
     except Exception as e:
         logging.error(f"Error generating audio: {str(e)}")
         raise
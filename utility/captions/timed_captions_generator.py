@@ -1,17 +1,32 @@
-import whisper_timestamped as whisper
-from whisper_timestamped import load_model, transcribe_timestamped
 import re
 import logging
+import numpy as np
 
-def generate_timed_captions(audio_filename, model_size="base"):
+def generate_timed_captions(audio_filename, model_size="base", device=None, word_boundaries=None):
     try:
-        WHISPER_MODEL = load_model(model_size)
-        gen = transcribe_timestamped(WHISPER_MODEL, audio_filename, verbose=False, fp16=False)
+        if word_boundaries:
+            gen = getWordBoundaryAnalysis(word_boundaries)
+        else:
+            gen = transcribe_with_whisper(audio_filename, model_size, device)
         return getCaptionsWithTime(gen)
     except Exception as e:
         logging.error(f"Error generating timed captions: {str(e)}")
         return None
 
+def transcribe_with_whisper(audio_filename, model_size="base", device=None):
+    # Imported lazily so the TTS word-boundary path never loads torch
+    from whisper_timestamped import transcribe_timestamped
+    from utility.captions.whisper_model_registry import get_model
+    WHISPER_MODEL = get_model(model_size, device)
+    return transcribe_timestamped(WHISPER_MODEL, audio_filename, verbose=False, fp16=False)
+
+def getWordBoundaryAnalysis(word_boundaries):
+    # Shape TTS word timings like a whisper_timestamped result so the same caption builder applies
+    return {
+        'text': ' '.join(word['text'] for word in word_boundaries),
+        'segments': [{'words': word_boundaries}]
+    }
+
 def splitWordsBySize(words, maxCaptionSize):
     halfCaptionSize = maxCaptionSize / 2
     captions = []
@@ -49,6 +64,18 @@ def getTimestampMapping(whisper_analysis):
             index = newIndex
     return locationToTimestamp
 
+def getTimestampIndex(whisper_analysis):
+    # Word ranges are contiguous, so the upper bounds alone form a sorted search index
+    rangeEnds = []
+    endTimes = []
+    index = 0
+    for segment in whisper_analysis['segments']:
+        for word in segment['words']:
+            index += len(word['text']) + 1
+            rangeEnds.append(index)
+            endTimes.append(word['end'])
+    return np.asarray(rangeEnds, dtype=np.int64), endTimes
+
 def cleanWord(word):
     return re.sub(r'[^\w\s\-_"\'\']', '', word)
 
@@ -58,10 +85,15 @@ def interpolateTimeFromDict(word_position, d):
             return value
     return None
 
+def interpolateTimesFromIndex(word_positions, timestamp_index):
+    rangeEnds, endTimes = timestamp_index
+    # The first range whose upper bound reaches the position is the one the dict scan would match
+    slots = np.searchsorted(rangeEnds, np.asarray(word_positions, dtype=np.int64), side='left')
+    return [endTimes[slot] if slot < len(endTimes) else None for slot in slots.tolist()]
+
 def getCaptionsWithTime(whisper_analysis, maxCaptionSize=15, considerPunctuation=False):
     try:
-        wordLocationToTime = getTimestampMapping(whisper_analysis)
-        position = 0
+        timestampIndex = getTimestampIndex(whisper_analysis)
         start_time = 0
         CaptionsPairs = []
         text = whisper_analysis['text']
@@ -73,9 +105,9 @@ def getCaptionsWithTime(whisper_analysis, maxCaptionSize=15, considerPunctuation
             words = text.split()
             words = [cleanWord(word) for word in splitWordsBySize(words, maxCaptionSize)]
         
-        for word in words:
-            position += len(word) + 1
-            end_time = interpolateTimeFromDict(position, wordLocationToTime)
+        positions = np.cumsum([len(word) + 1 for word in words], dtype=np.int64)
+        end_times = interpolateTimesFromIndex(positions, timestampIndex)
+        for word, end_time in zip(words, end_times):
             if end_time and word:
                 CaptionsPairs.append(((start_time, end_time), word))
                 start_time = end_time
@@ -0,0 +1,60 @@
+import os
+import threading
+import logging
+import whisper
+import torch
+from whisper_timestamped import load_model
+
+# Loaded models stay resident for the life of the process, keyed by (model_size, device)
+_models = {}
+_lock = threading.Lock()
+
+def get_default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def get_download_root():
+    default = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
+
+def get_checkpoint_path(model_size):
+    if model_size in whisper._MODELS:
+        return os.path.join(get_download_root(), os.path.basename(whisper._MODELS[model_size]))
+    # Custom checkpoints are passed to load_model as a file path
+    return model_size
+
+def is_checkpoint_cached(model_size):
+    return os.path.isfile(get_checkpoint_path(model_size))
+
+def get_model(model_size="base", device=None):
+    device = device or get_default_device()
+    key = (model_size, device)
+    with _lock:
+        model = _models.get(key)
+        if model is None:
+            logging.info(f"Loading Whisper model '{model_size}' on {device}")
+            model = load_model(model_size, device=device)
+            _models[key] = model
+        return model
+
+def evict_model(model_size=None, device=None):
+    with _lock:
+        keys = [key for key in _models
+                if (model_size is None or key[0] == model_size) and (device is None or key[1] == device)]
+        for key in keys:
+            del _models[key]
+            logging.info(f"Evicted Whisper model '{key[0]}' on {key[1]}")
+    if keys and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return len(keys)
+
+def loaded_models():
+    with _lock:
+        return list(_models.keys())
+
+def prewarm(model_size="base", device=None, require_cached=True):
+    if not is_checkpoint_cached(model_size):
+        message = f"Whisper checkpoint for '{model_size}' not found in local cache: {get_checkpoint_path(model_size)}"
+        if require_cached:
+            raise FileNotFoundError(message)
+        logging.warning(f"{message} (it will be downloaded)")
+    return get_model(model_size, device)
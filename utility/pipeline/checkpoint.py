@@ -0,0 +1,88 @@
+import os
+import time
+import json
+import hashlib
+import asyncio
+import inspect
+import logging
+from utility.utils import ensure_directory_exists, write_file_atomic
+
+PIPELINE_STAGES = ["script", "audio", "captions", "search_queries", "clip_urls", "downloads", "render"]
+
+def hash_value(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def hash_file(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class StageCache:
+    # Each stage records a hash of its inputs and its JSON output in the job directory. A re-run
+    # reuses the recorded output while the inputs hash the same and every artifact file still exists.
+
+    def __init__(self, job_dir, force_stages=(), on_event=None):
+        self.job_dir = job_dir
+        self.force_stages = set(force_stages)
+        self.on_event = on_event
+        # Per-stage wall time and whether the recorded output was reused, for job reports
+        self.timings = {}
+        ensure_directory_exists(job_dir)
+
+    def manifest_path(self, stage):
+        return os.path.join(self.job_dir, f"{stage}.stage.json")
+
+    def load_manifest(self, stage):
+        try:
+            with open(self.manifest_path(stage)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def load_output(self, stage):
+        manifest = self.load_manifest(stage)
+        return manifest["output"] if manifest else None
+
+    async def run(self, stage, inputs, compute, artifacts=None):
+        started = time.perf_counter()
+        input_hash = hash_value(inputs)
+        manifest = self.load_manifest(stage)
+        if (stage not in self.force_stages and manifest and manifest["input_hash"] == input_hash
+                and all(os.path.exists(path) for path in manifest["artifacts"])):
+            logging.info(f"Stage '{stage}' inputs unchanged, reusing {self.manifest_path(stage)}")
+            self.timings[stage] = {"seconds": round(time.perf_counter() - started, 3), "reused": True}
+            self.emit(stage, "reused")
+            return manifest["output"]
+
+        logging.info(f"Running stage '{stage}'")
+        self.emit(stage, "running")
+        try:
+            output = compute()
+            if inspect.isawaitable(output):
+                output = await output
+        except BaseException as e:
+            self.emit(stage, "cancelled" if isinstance(e, asyncio.CancelledError) else "failed")
+            raise
+        finally:
+            self.timings[stage] = {"seconds": round(time.perf_counter() - started, 3), "reused": False}
+        if output is None:
+            self.emit(stage, "failed")
+            return None
+
+        # Round-trip through JSON so a fresh result looks exactly like one read back on a re-run
+        output = json.loads(json.dumps(output))
+        manifest = {
+            "stage": stage,
+            "input_hash": input_hash,
+            "artifacts": list(artifacts(output) if callable(artifacts) else artifacts or []),
+            "output": output
+        }
+        write_file_atomic(self.manifest_path(stage), json.dumps(manifest, indent=2))
+        self.emit(stage, "done")
+        return output
+
+    def emit(self, stage, status):
+        if self.on_event:
+            self.on_event({"event": "stage", "stage": stage, "status": status, **self.timings.get(stage, {})})
@@ -0,0 +1,23 @@
+import os
+from utility.utils import ensure_directory_exists
+
+# Point this at shared storage when queue workers on several machines share jobs
+DIRECTORY_JOBS = os.environ.get("JOBS_DIR", "jobs")
+
+class JobContext:
+    # Everything a job writes outside the shared caches goes under its own workspace, so any number
+    # of pipelines can run side by side from the same working directory without clobbering each other
+
+    def __init__(self, job_id, workspace=None):
+        self.job_id = job_id
+        self.workspace = os.path.abspath(workspace or os.path.join(DIRECTORY_JOBS, job_id))
+        ensure_directory_exists(self.workspace)
+        self.audio_file = self.path("audio_tts.wav")
+        self.output_file = self.path("rendered_video.mp4")
+
+    def path(self, *parts):
+        return os.path.join(self.workspace, *parts)
+
+    def log_directory(self, directory):
+        # The shared .logs/... layout, rooted in the workspace
+        return self.path(directory)
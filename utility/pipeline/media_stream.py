@@ -0,0 +1,160 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from utility.video.background_video_generator import generate_video_url_async, MAX_CONCURRENT_SEARCHES
+from utility.video.video_search_query_generator import merge_empty_intervals
+from utility.render.media_cache import get_clip_media
+from utility.render.mezzanine import prepare_source_clip
+from utility.render.media_leases import lease_media
+from utility.render.ffmpeg_utils import probe_duration
+
+# Overlap clip search, download and preparation instead of running them one after another
+MEDIA_OVERLAP_ENABLED = os.environ.get("MEDIA_OVERLAP", "1") not in ("", "0", "false")
+DOWNLOAD_WORKERS = 4
+PREP_WORKERS = 2
+# Bounded, so searching pauses once downloads fall this far behind and downloads wait for preparation
+MEDIA_QUEUE_SIZE = 8
+
+class StageTimer:
+    # Busy intervals per stage, for working out how much of the wall time the stages overlapped
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.intervals = {}
+
+    def add(self, stage, started, finished):
+        self.intervals.setdefault(stage, []).append((started, finished))
+
+    @contextmanager
+    def busy(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, started, time.perf_counter())
+
+    def report(self):
+        finished = time.perf_counter()
+        points = sorted({self.started, finished} | {t for intervals in self.intervals.values() for interval in intervals for t in interval})
+        busy = dict.fromkeys(self.intervals, 0.0)
+        overlapped = 0.0
+        for start, end in zip(points, points[1:]):
+            # Every interval starts and ends on a point, so each stage is either busy for the whole
+            # stretch between two neighbouring points or not at all
+            active = [stage for stage, intervals in self.intervals.items()
+                      if any(t1 <= start and end <= t2 for t1, t2 in intervals)]
+            for stage in active:
+                busy[stage] += end - start
+            if len(active) > 1:
+                overlapped += end - start
+        wall = finished - self.started
+        return {
+            "wall_seconds": round(wall, 3),
+            "busy_seconds": {stage: round(seconds, 3) for stage, seconds in busy.items()},
+            "overlapped_seconds": round(overlapped, 3),
+            "overlapped_fraction": round(overlapped / wall, 3) if wall else 0.0
+        }
+
+def prepare_clip(source_filename, holder=None):
+    prepared_filename = prepare_source_clip(source_filename)
+    # Reading the header now surfaces a truncated download before the render opens the clip
+    if probe_duration(prepared_filename) is None:
+        logging.warning(f"Prepared clip has no readable duration: {prepared_filename}")
+    if holder:
+        # Searching can run long; the lease keeps eviction off the clip until the job's render is done
+        lease_media(holder, [prepared_filename])
+    return prepared_filename
+
+async def run_in_thread(func, *args):
+    return await asyncio.to_thread(func, *args)
+
+async def fetch_background_media_async(timed_video_searches, video_server, max_concurrent_searches=MAX_CONCURRENT_SEARCHES,
+                                       assignment="greedy", context=None, client=None, run_download=run_in_thread):
+    # Clip search, download and preparation connected by bounded queues: a segment's clip is fetched
+    # and prepared as soon as its URL is final, while later segments are still being searched.
+    # Clips land in the media and mezzanine caches, so the downloads stage that follows only looks
+    # them up. Returns the merged clip URLs, exactly as merge_empty_intervals(generate_video_url_async(...)),
+    # and the overlap report. Downloads and preparation go through run_download, so a caller can
+    # hold them to the same limits as its downloads stage.
+    timer = StageTimer()
+    downloads = asyncio.Queue(MEDIA_QUEUE_SIZE)
+    preps = asyncio.Queue(MEDIA_QUEUE_SIZE)
+    selected = []
+    queued = []
+    search_started = None
+
+    async def queue_final_segments(final):
+        # A segment without a clip is merged into the one before it, so a merged segment is only
+        # final (and its span known) once a later segment has been chosen, or the search is done
+        merged = merge_empty_intervals(selected)
+        for segment in merged[len(queued):len(merged) if final else len(merged) - 1]:
+            queued.append(segment)
+            await downloads.put(segment)
+
+    async def on_url(item):
+        nonlocal search_started
+        selected.append(item)
+        # Waiting for room in the download queue is back-pressure, not search work, so the search
+        # stage's busy time stops here and picks up again once the segment is queued
+        timer.add("search", search_started, time.perf_counter())
+        await queue_final_segments(False)
+        search_started = time.perf_counter()
+
+    async def download_worker():
+        while True:
+            segment = await downloads.get()
+            if segment is None:
+                return
+            (t1, t2), video_url = segment
+            if not video_url:
+                continue
+            with timer.busy("download"):
+                try:
+                    source_filename = await run_download(get_clip_media, video_url, t2 - t1)
+                except Exception as e:
+                    logging.error(f"Error downloading {video_url}: {str(e)}")
+                    source_filename = None
+            if source_filename:
+                await preps.put(source_filename)
+            else:
+                logging.warning(f"Failed to download video from {video_url}")
+
+    async def prep_worker():
+        while True:
+            source_filename = await preps.get()
+            if source_filename is None:
+                return
+            with timer.busy("prep"):
+                try:
+                    await run_download(prepare_clip, source_filename, context.workspace if context else None)
+                except Exception as e:
+                    logging.error(f"Error preparing {source_filename}: {str(e)}")
+
+    download_tasks = [asyncio.create_task(download_worker()) for _ in range(DOWNLOAD_WORKERS)]
+    prep_tasks = [asyncio.create_task(prep_worker()) for _ in range(PREP_WORKERS)]
+    try:
+        search_started = time.perf_counter()
+        try:
+            timed_video_urls = await generate_video_url_async(
+                timed_video_searches, video_server, max_concurrent_searches, assignment, context, client, on_url)
+        finally:
+            timer.add("search", search_started, time.perf_counter())
+        await queue_final_segments(True)
+        for _ in download_tasks:
+            await downloads.put(None)
+        await asyncio.gather(*download_tasks)
+        for _ in prep_tasks:
+            await preps.put(None)
+        await asyncio.gather(*prep_tasks)
+    finally:
+        for task in download_tasks + prep_tasks:
+            task.cancel()
+
+    report = timer.report()
+    logging.info(f"Clip search, download and preparation overlapped for {report['overlapped_seconds']}s "
+                 f"of {report['wall_seconds']}s ({report['overlapped_fraction']:.0%}); busy: {report['busy_seconds']}")
+    if timed_video_urls is None:
+        return None, report
+    return merge_empty_intervals(timed_video_urls), report
@@ -0,0 +1,285 @@
+import os
+import time
+import asyncio
+import inspect
+import logging
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from utility.utils import CLIP_FETCH_MODE
+from utility.audio.audio_generator import generate_audio, synthesize_stream, VOICE, RATE
+from utility.captions.timed_captions_generator import generate_timed_captions
+from utility.video.background_video_generator import generate_video_url_async, create_search_client
+from utility.render.render_engine import get_output_media, resolve_background_media
+from utility.render.mezzanine import MEZZANINE_ENABLED
+from utility.render.media_leases import lease_media, release_media
+from utility.render.caption_style import CAPTION_STYLE, VIDEO_SIZE, VIDEO_FPS
+from utility.video.video_search_query_generator import getVideoSearchQueriesTimed, merge_empty_intervals, model, prompt, QUERY_WINDOW_TOKENS
+from utility.script.script_generator import generate_script, ScriptStream
+from utility.pipeline.checkpoint import StageCache, PIPELINE_STAGES, hash_file
+from utility.pipeline.job_context import JobContext
+from utility.pipeline.subprocess_worker import run_in_subprocess
+from utility.pipeline.media_stream import fetch_background_media_async, MEDIA_OVERLAP_ENABLED
+
+VIDEO_SERVER = "pexel"
+
+# Stages that wait on the network run on the event loop, each behind its own limit
+IO_STAGES = ["script", "audio", "search_queries", "clip_urls", "downloads"]
+
+class StagePools:
+    # One bounded pool per stage, sized to what the stage spends its time on: network stages share
+    # the event loop behind per-stage semaphores, Whisper gets a small process pool so each worker
+    # keeps its model loaded, and rendering gets a CPU-sized process pool.
+
+    def __init__(self, io_workers=4, whisper_workers=1, render_workers=None):
+        self.limits = {stage: asyncio.Semaphore(io_workers) for stage in IO_STAGES}
+        self.executors = {
+            "captions": ProcessPoolExecutor(max_workers=whisper_workers),
+            "render": ProcessPoolExecutor(max_workers=render_workers or max(1, os.cpu_count() // 2))
+        }
+
+    async def run(self, stage, func, *args, **kwargs):
+        if stage in self.executors:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executors[stage], partial(func, *args, **kwargs))
+        async with self.limits[stage]:
+            if asyncio.iscoroutinefunction(func):
+                return await func(*args, **kwargs)
+            # Blocking clients (LLM SDKs, requests) run in a thread so the loop keeps serving other jobs
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown()
+
+class ServicePools(StagePools):
+    # Pools for a long-lived server process. Whisper runs in a thread of the server itself so the
+    # model registry keeps the model warm between jobs, Pexels searches share one HTTP client, and
+    # every render gets its own subprocess so cancelling a job can kill it.
+
+    def __init__(self, io_workers=4, render_workers=None):
+        self.limits = {stage: asyncio.Semaphore(io_workers) for stage in IO_STAGES}
+        self.executors = {}
+        self.whisper_limit = asyncio.Semaphore(1)
+        self.render_limit = asyncio.Semaphore(render_workers or max(1, os.cpu_count() // 2))
+        self.search_client = create_search_client()
+
+    def for_job(self, on_render_progress=None):
+        return JobPools(self, on_render_progress)
+
+    async def close(self):
+        await self.search_client.aclose()
+
+class JobPools:
+    # One job's view of the shared service pools, routing its render progress back to the job
+
+    def __init__(self, pools, on_render_progress=None):
+        self.pools = pools
+        self.on_render_progress = on_render_progress
+
+    async def run(self, stage, func, *args, **kwargs):
+        if stage == "captions":
+            async with self.pools.whisper_limit:
+                return await asyncio.to_thread(func, *args, **kwargs)
+        if stage == "render":
+            async with self.pools.render_limit:
+                return await run_in_subprocess(func, args, kwargs, on_progress=self.on_render_progress)
+        if stage == "clip_urls":
+            kwargs["client"] = self.pools.search_client
+        return await self.pools.run(stage, func, *args, **kwargs)
+
+async def run_in_pool(pools, stage, func, *args, **kwargs):
+    if pools is None:
+        result = func(*args, **kwargs)
+        return await result if inspect.isawaitable(result) else result
+    return await pools.run(stage, func, *args, **kwargs)
+
+def generate_script_or_none(topic, video_type):
+    script = generate_script(topic, video_type)
+    # generate_script reports failures as an "Error: ..." string instead of raising
+    if not script or script.startswith("Error"):
+        return None
+    return script
+
+async def stream_script_and_prefetch_audio(topic, video_type):
+    # Synthesizes each sentence while the rest of the script is still streaming in. The chunks land
+    # in the TTS cache, so the audio stage that follows stitches them without synthesizing again.
+    stream = ScriptStream(topic, video_type)
+    runner = asyncio.create_task(stream.run())
+    try:
+        await synthesize_stream(stream.subscribe(), VOICE, RATE)
+    except Exception as e:
+        if stream.error is None:
+            logging.warning(f"Streaming speech synthesis failed, the audio stage will redo it: {str(e)}")
+    return await runner
+
+class PipelineRun:
+    # One job's pass through the pipeline. Each stage reads what earlier stages produced from
+    # self.outputs, so a stage can run on its own once those outputs are loaded back from the
+    # job's stage manifests, which is how queue workers pick a job up mid-way.
+
+    def __init__(self, job, pools=None, force_stages=(), on_event=None):
+        self.job = job
+        self.pools = pools
+        self.context = JobContext(job["job_id"], job.get("job_dir"))
+        self.stages = StageCache(self.context.workspace, force_stages, on_event)
+        self.outputs = {}
+        self.media_overlap = None
+
+    def load_outputs(self, stage):
+        for upstream in PIPELINE_STAGES[:PIPELINE_STAGES.index(stage)]:
+            if upstream not in self.outputs:
+                self.outputs[upstream] = self.stages.load_output(upstream)
+
+    async def run_stage(self, stage):
+        self.load_outputs(stage)
+        output = await getattr(self, f"run_{stage}")()
+        self.outputs[stage] = output
+        return output
+
+    async def run_all(self):
+        for stage in PIPELINE_STAGES:
+            if await self.run_stage(stage) is None:
+                logging.warning(f"Stage '{stage}' produced no output for job {self.job['job_id']}")
+                return None
+        return self.outputs["render"]
+
+    async def run_script(self):
+        job = self.job
+        if "script" in job:
+            script = job["script"]
+        elif "script_file" in job:
+            with open(job["script_file"], 'r') as file:
+                script = file.read().strip()
+        else:
+            video_type = job.get("video_type", "short")
+            generate = stream_script_and_prefetch_audio if job.get("stream_script") else generate_script_or_none
+            return await self.stages.run(
+                "script", {"topic": job["topic"], "video_type": video_type},
+                lambda: run_in_pool(self.pools, "script", generate, job["topic"], video_type))
+        return await self.stages.run("script", {"script": script}, lambda: script)
+
+    async def run_audio(self):
+        # Generate audio from the script
+        script = self.outputs["script"]
+        audio_file = self.context.audio_file
+        word_boundaries = await self.stages.run(
+            "audio", {"script": script, "voice": VOICE, "rate": RATE},
+            lambda: run_in_pool(self.pools, "audio", generate_audio, script, audio_file), artifacts=[audio_file])
+        logging.info(f"Audio generated: {audio_file}")
+        return word_boundaries
+
+    async def run_captions(self):
+        # Generate timed captions, from the TTS word timings unless Whisper is requested
+        audio_file = self.context.audio_file
+        word_boundaries = self.outputs["audio"]
+        if self.job.get("captions", "tts") == 'whisper' or not word_boundaries:
+            word_boundaries = None
+            compute_captions = lambda: run_in_pool(self.pools, "captions", generate_timed_captions, audio_file)
+        else:
+            # Building captions from word timings is cheap enough to skip the Whisper pool
+            compute_captions = lambda: generate_timed_captions(audio_file, word_boundaries=word_boundaries)
+        timed_captions = await self.stages.run(
+            "captions", {"audio": hash_file(audio_file), "word_boundaries": word_boundaries}, compute_captions)
+        logging.info(f"Timed captions generated: {len(timed_captions) if timed_captions else 0} captions")
+        return timed_captions or None
+
+    async def run_search_queries(self):
+        # Generate search terms for background videos
+        script, timed_captions = self.outputs["script"], self.outputs["captions"]
+        search_terms = await self.stages.run(
+            "search_queries", {"script": script, "captions": timed_captions, "model": model, "prompt": prompt,
+             "window_tokens": QUERY_WINDOW_TOKENS},
+            lambda: run_in_pool(self.pools, "search_queries", getVideoSearchQueriesTimed, script, timed_captions, self.context))
+        logging.info(f"Search terms generated: {len(search_terms) if search_terms else 0} terms")
+        return search_terms
+
+    async def run_clip_urls(self):
+        # Generate background video URLs, merging empty intervals into their neighbours
+        search_terms = self.outputs["search_queries"]
+        clip_assignment = self.job.get("clip_assignment", "greedy")
+
+        async def compute():
+            if MEDIA_OVERLAP_ENABLED:
+                # Also downloads and prepares every clip while the search runs, leaving the downloads
+                # stage nothing but cache hits. That work takes slots from the downloads pool, so
+                # concurrent jobs stay within its limit.
+                kwargs = {"run_download": partial(run_in_pool, self.pools, "downloads")} if self.pools else {}
+                background_video_urls, self.media_overlap = await run_in_pool(
+                    self.pools, "clip_urls", fetch_background_media_async, search_terms, VIDEO_SERVER,
+                    assignment=clip_assignment, context=self.context, **kwargs)
+                return background_video_urls
+            background_video_urls = await run_in_pool(
+                self.pools, "clip_urls", generate_video_url_async, search_terms, VIDEO_SERVER,
+                assignment=clip_assignment, context=self.context)
+            return merge_empty_intervals(background_video_urls) if background_video_urls is not None else None
+
+        background_video_urls = await self.stages.run(
+            "clip_urls", {"search_terms": search_terms, "assignment": clip_assignment, "fetch_mode": CLIP_FETCH_MODE}, compute)
+        logging.info(f"Background video URLs generated: {len(background_video_urls) if background_video_urls else 0} URLs")
+        return background_video_urls
+
+    async def run_downloads(self):
+        # Clips live in the shared media cache; the stage re-runs if any of them was evicted. The job
+        # leases them (keyed by its workspace) so eviction leaves them alone until the render is done.
+        background_video_urls = self.outputs["clip_urls"]
+        background_media = await self.stages.run(
+            "downloads", {"clip_urls": background_video_urls, "mezzanine": MEZZANINE_ENABLED},
+            lambda: run_in_pool(self.pools, "downloads", resolve_background_media, background_video_urls, self.context.workspace),
+            artifacts=lambda media: [video_filename for _, video_filename in media])
+        logging.info(f"Background clips ready: {len(background_media) if background_media is not None else 0} clips")
+        return background_media
+
+    async def run_render(self):
+        # Generate the final video from the clip files the downloads stage resolved
+        audio_file = self.context.audio_file
+        timed_captions, background_media = self.outputs["captions"], self.outputs["downloads"]
+        render_backend = self.job.get("render_backend", "moviepy")
+        render_inputs = {
+            "audio": hash_file(audio_file),
+            "captions": timed_captions,
+            "background_media": background_media,
+            "backend": render_backend,
+            "caption_style": CAPTION_STYLE,
+            "video_size": VIDEO_SIZE,
+            "video_fps": VIDEO_FPS
+        }
+
+        async def compute():
+            media = background_media
+            # Renewed here too, for a render that starts long after its downloads stage ran
+            await asyncio.to_thread(lease_media, self.context.workspace, [video_filename for _, video_filename in media])
+            if not all(os.path.exists(video_filename) for _, video_filename in media):
+                # Evicted since, or this is a queue worker on another machine: the downloads stage
+                # finds its artifacts missing and fetches the clips into this machine's cache again
+                logging.info("Background clips missing locally, running the downloads stage again")
+                media = await self.run_stage("downloads")
+                if media is None:
+                    return None
+            return await run_in_pool(self.pools, "render", get_output_media, audio_file, timed_captions, media,
+                                     VIDEO_SERVER, render_backend, self.job.get("render_slices", 1), self.context)
+
+        video = await self.stages.run("render", render_inputs, compute, artifacts=[self.context.output_file])
+        if video:
+            await asyncio.to_thread(release_media, self.context.workspace)
+        logging.info(f"Output video generated: {video}")
+        return video
+
+async def run_job(job, pools=None, force_stages=(), on_event=None):
+    started = time.perf_counter()
+    run = PipelineRun(job, pools, force_stages, on_event)
+    result = {"job_id": job["job_id"], "status": "failed", "output": None, "error": None}
+    try:
+        video = await run.run_all()
+        result["output"] = video
+        if video:
+            result["status"] = "ok"
+        else:
+            result["error"] = "No video generated"
+    except Exception as e:
+        logging.error(f"Job {job['job_id']} failed: {str(e)}")
+        result["error"] = str(e)
+    result["stages"] = run.stages.timings
+    if run.media_overlap:
+        result["media_overlap"] = run.media_overlap
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import pickle
+import signal
+import asyncio
+import logging
+import tempfile
+
+# Runs one pickled call in a child process that can be killed outright, along with any ffmpeg it
+# started. The child reports progress and its result as JSON lines on stdout.
+
+# The child imports the utility package by module name, whatever directory the server runs from
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def get_child_env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+    return env
+
+async def run_in_subprocess(func, args=(), kwargs=None, on_progress=None, work_dir=None):
+    with tempfile.NamedTemporaryFile("wb", suffix=".call", dir=work_dir, delete=False) as f:
+        pickle.dump((func, args, kwargs or {}, on_progress is not None), f)
+        payload_file = f.name
+
+    # A new session puts the child and its ffmpeg processes in one process group
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "utility.pipeline.subprocess_worker", payload_file,
+        stdout=asyncio.subprocess.PIPE, env=get_child_env(), start_new_session=(os.name != "nt"))
+    result = None
+    try:
+        async for line in process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message.get("event") == "progress" and on_progress:
+                on_progress(message["phase"], message["index"], message["total"])
+            elif message.get("event") == "result":
+                result = message
+        await process.wait()
+    except asyncio.CancelledError:
+        kill_process_group(process)
+        await process.wait()
+        raise
+    finally:
+        os.remove(payload_file)
+
+    if process.returncode != 0 or result is None:
+        raise RuntimeError(f"Worker process exited with code {process.returncode}")
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result["value"]
+
+def kill_process_group(process):
+    if process.returncode is not None:
+        return
+    logging.info(f"Killing worker process {process.pid}")
+    try:
+        if os.name == "nt":
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def main(payload_file):
+    from utility.render.progress import RenderProgressLogger, write_progress_line
+    # Keep the stdout pipe for protocol lines only: stray prints and anything this process spawns
+    # (which could otherwise hold the pipe open after we exit) are sent to stderr instead
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    with open(payload_file, "rb") as f:
+        func, args, kwargs, with_progress = pickle.load(f)
+    if with_progress:
+        kwargs["logger"] = RenderProgressLogger(lambda phase, index, total: write_progress_line(phase, index, total, protocol))
+    try:
+        message = {"event": "result", "value": func(*args, **kwargs)}
+    except Exception as e:
+        message = {"event": "result", "error": str(e)}
+    protocol.write(json.dumps(message) + "\n")
+    protocol.flush()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main(sys.argv[1])
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from utility.utils import ensure_directory_exists
+from utility.pipeline.checkpoint import PIPELINE_STAGES
+
+WORK_QUEUE_PATH = os.environ.get("WORK_QUEUE_PATH", "work_queue.sqlite3")
+LEASE_SECONDS = int(os.environ.get("WORK_QUEUE_LEASE", 120))
+MAX_ATTEMPTS = int(os.environ.get("WORK_QUEUE_MAX_ATTEMPTS", 3))
+RETRY_BACKOFF = 30
+
+class WorkQueue:
+    # Durable queue of pipeline stages. Each job has one row per stage it has reached; a worker leases
+    # a row, keeps the lease alive with heartbeats while the stage runs, and on success enqueues the
+    # next stage in the same transaction. A lease that expires (the worker died) makes the stage
+    # claimable again, so a crash costs at most the stage that was running.
+    #
+    # The file can sit on storage shared between machines. The rollback journal is kept instead of
+    # WAL because WAL needs shared memory, which network file systems do not provide.
+
+    def __init__(self, path=WORK_QUEUE_PATH):
+        ensure_directory_exists(os.path.dirname(os.path.abspath(path)))
+        # Autocommit mode, so every transaction below is opened explicitly
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            job_id TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            spec TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires REAL,
+            available_at REAL NOT NULL,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (job_id, stage)
+        )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS tasks_claimable ON tasks (status, stage, available_at)")
+
+    def transaction(self):
+        return Transaction(self.connection)
+
+    def submit(self, job, stage=PIPELINE_STAGES[0]):
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO tasks (job_id, stage, spec, status, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+                (job["job_id"], stage, json.dumps(job), now, now, now))
+
+    def claim(self, worker_id, stages=PIPELINE_STAGES, lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        placeholders = ",".join("?" * len(stages))
+        with self.transaction() as connection:
+            while True:
+                row = connection.execute(
+                    f"SELECT job_id, stage, spec, attempts FROM tasks WHERE stage IN ({placeholders}) AND "
+                    "((status = 'pending' AND available_at <= ?) OR (status = 'leased' AND lease_expires < ?)) "
+                    "ORDER BY created_at LIMIT 1",
+                    (*stages, now, now)).fetchone()
+                if row is None:
+                    return None
+                job_id, stage, spec, attempts = row
+                if attempts < MAX_ATTEMPTS:
+                    break
+                # Its last lease ran out without a result: the stage keeps killing its worker. Fail it
+                # and look for the next claimable row, so None always means nothing is left to claim.
+                connection.execute(
+                    "UPDATE tasks SET status = 'failed', error = 'Lease expired on the final attempt', "
+                    "lease_owner = NULL, updated_at = ? WHERE job_id = ? AND stage = ?", (now, job_id, stage))
+                logging.error(f"Giving up on stage '{stage}' of job {job_id} after {attempts} attempts")
+            connection.execute(
+                "UPDATE tasks SET status = 'leased', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, "
+                "updated_at = ? WHERE job_id = ? AND stage = ?",
+                (worker_id, now + lease_seconds, now, job_id, stage))
+        return {"job_id": job_id, "stage": stage, "spec": json.loads(spec), "attempt": attempts + 1}
+
+    def heartbeat(self, task, worker_id, lease_seconds=LEASE_SECONDS):
+        # False means the lease was lost (it expired and someone else claimed the stage)
+        with self.transaction() as connection:
+            return connection.execute(
+                "UPDATE tasks SET lease_expires = ?, updated_at = ? "
+                "WHERE job_id = ? AND stage = ? AND status = 'leased' AND lease_owner = ?",
+                (time.time() + lease_seconds, time.time(), task["job_id"], task["stage"], worker_id)).rowcount == 1
+
+    def complete(self, task, worker_id):
+        now = time.time()
+        with self.transaction() as connection:
+            updated = connection.execute(
+                "UPDATE tasks SET status = 'done', lease_owner = NULL, error = NULL, updated_at = ? "
+                "WHERE job_id = ? AND stage = ? AND status = 'leased' AND lease_owner = ?",
+                (now, task["job_id"], task["stage"], worker_id)).rowcount
+            if not updated:
+                return False
+            next_index = PIPELINE_STAGES.index(task["stage"]) + 1
+            if next_index < len(PIPELINE_STAGES):
+                connection.execute(
+                    "INSERT OR REPLACE INTO tasks (job_id, stage, spec, status, available_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+                    (task["job_id"], PIPELINE_STAGES[next_index], json.dumps(task["spec"]), now, now, now))
+        return True
+
+    def fail(self, task, worker_id, error):
+        now = time.time()
+        retry = task["attempt"] < MAX_ATTEMPTS
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = ?, available_at = ?, lease_owner = NULL, error = ?, updated_at = ? "
+                "WHERE job_id = ? AND stage = ? AND status = 'leased' AND lease_owner = ?",
+                ("pending" if retry else "failed", now + RETRY_BACKOFF * task["attempt"], error, now,
+                 task["job_id"], task["stage"], worker_id))
+        return retry
+
+    def job_status(self, job_id):
+        rows = self.connection.execute(
+            "SELECT stage, status, attempts, error FROM tasks WHERE job_id = ?", (job_id,)).fetchall()
+        return {stage: {"status": status, "attempts": attempts, "error": error} for stage, status, attempts, error in rows}
+
+    def summary(self):
+        return self.connection.execute(
+            "SELECT stage, status, COUNT(*) FROM tasks GROUP BY stage, status ORDER BY stage").fetchall()
+
+class Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so two workers cannot both read a row as
+    # claimable and then both lease it
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
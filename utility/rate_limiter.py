@@ -0,0 +1,183 @@
+import os
+import re
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import threading
+from utility.utils import DIRECTORY_CACHE, ensure_directory_exists
+
+# Every process that points here shares the same buckets; put it on shared storage to coordinate
+# workers on several machines as well
+RATE_LIMIT_PATH = os.environ.get("RATE_LIMIT_PATH", os.path.join(DIRECTORY_CACHE, "rate_limits.sqlite3"))
+# "<requests>/<seconds>": the bucket refills at that rate and holds at most <requests> tokens
+PEXELS_RATE_LIMIT = os.environ.get("PEXELS_RATE_LIMIT", "200/3600")
+MEDIA_RATE_LIMIT = os.environ.get("MEDIA_RATE_LIMIT", "20/1")
+LLM_RATE_LIMIT = os.environ.get("LLM_RATE_LIMIT", "60/60")
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+# Spreads out processes that were all paused by the same 429, so they do not retry in lockstep
+WAKEUP_JITTER = 0.5
+
+# Pexels sends X-Ratelimit-Remaining and X-Ratelimit-Reset (a Unix time); OpenAI and Groq send
+# x-ratelimit-remaining-requests and x-ratelimit-reset-requests (a duration such as "1m30s")
+REMAINING_HEADERS = ("x-ratelimit-remaining", "x-ratelimit-remaining-requests")
+RESET_HEADERS = ("x-ratelimit-reset", "x-ratelimit-reset-requests")
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+_local = threading.local()
+
+def parse_rate_limit(value):
+    requests, seconds = value.split("/")
+    return float(requests) / float(seconds), float(requests)
+
+def get_header(headers, names):
+    if headers is None:
+        return None
+    # requests and httpx headers ignore case; plain dicts from tests or logs may not
+    lowered = {key.lower(): value for key, value in headers.items()}
+    for name in names:
+        if name in lowered:
+            return lowered[name]
+    return None
+
+def parse_reset_time(value, now):
+    try:
+        seconds = float(value)
+        # Large values are Unix times, small ones are seconds from now
+        return seconds if seconds > 1e9 else now + seconds
+    except ValueError:
+        pass
+    matches = DURATION_PATTERN.findall(value)
+    if not matches:
+        return None
+    return now + sum(float(amount) * DURATION_UNITS[unit] for amount, unit in matches)
+
+def get_retry_after(headers):
+    value = get_header(headers, ("retry-after",))
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def get_backoff_delay(attempt, retry_after=None):
+    # Full jitter: a random delay up to the exponential cap, never shorter than the server asked for
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after + random.uniform(0, WAKEUP_JITTER)) if retry_after else delay
+
+def get_connection(path):
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path not in connections:
+        ensure_directory_exists(os.path.dirname(os.path.abspath(path)))
+        # Autocommit mode, so every transaction below is opened explicitly. The rollback journal is
+        # kept instead of WAL so the file also works on network file systems.
+        connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        connection.execute("""CREATE TABLE IF NOT EXISTS buckets (
+            name TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            blocked_until REAL NOT NULL DEFAULT 0
+        )""")
+        connections[path] = connection
+    return connections[path]
+
+class RateLimiter:
+    # Token bucket kept in SQLite, so every process on the machine (or on the shared storage) draws
+    # from the same budget. A caller takes its token straight away and sleeps until the bucket
+    # would have refilled it, which spaces callers out evenly instead of letting them poll. The
+    # API's own quota headers shrink the bucket, and a 429 pauses every caller until it is safe
+    # to try again.
+
+    def __init__(self, name, limit, path=RATE_LIMIT_PATH):
+        self.name = name
+        self.rate, self.capacity = parse_rate_limit(limit)
+        self.path = path
+
+    def update_bucket(self, change):
+        # change(tokens, blocked_until, now) returns the new (tokens, blocked_until) and a result
+        connection = get_connection(self.path)
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated_at, blocked_until FROM buckets WHERE name = ?", (self.name,)).fetchone()
+            tokens, updated_at, blocked_until = row if row else (self.capacity, now, 0.0)
+            tokens = min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+            tokens, blocked_until, result = change(tokens, blocked_until, now)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (name, tokens, updated_at, blocked_until) VALUES (?, ?, ?, ?)",
+                (self.name, tokens, now, blocked_until))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    def reserve(self):
+        # (granted, seconds to wait): a granted token is usable after the wait; otherwise the bucket
+        # is paused and the caller should ask again after it
+        def change(tokens, blocked_until, now):
+            if blocked_until > now:
+                return tokens, blocked_until, (False, blocked_until - now)
+            tokens -= 1
+            return tokens, blocked_until, (True, max(0.0, -tokens / self.rate))
+        return self.update_bucket(change)
+
+    def acquire(self):
+        while True:
+            granted, wait = self.reserve()
+            if granted:
+                if wait:
+                    time.sleep(wait)
+                return
+            time.sleep(wait + random.uniform(0, WAKEUP_JITTER))
+
+    async def acquire_async(self):
+        # The bucket's transaction can wait up to the SQLite busy timeout on other processes, so it
+        # runs in a thread to keep the event loop serving other jobs meanwhile
+        while True:
+            granted, wait = await asyncio.to_thread(self.reserve)
+            if granted:
+                if wait:
+                    await asyncio.sleep(wait)
+                return
+            await asyncio.sleep(wait + random.uniform(0, WAKEUP_JITTER))
+
+    def pause(self, seconds):
+        def change(tokens, blocked_until, now):
+            return tokens, max(blocked_until, now + seconds), None
+        self.update_bucket(change)
+
+    def update_from_headers(self, headers):
+        remaining = get_header(headers, REMAINING_HEADERS)
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        reset = get_header(headers, RESET_HEADERS)
+
+        def change(tokens, blocked_until, now):
+            # Only ever lowers the budget: requests still in flight are not counted in the header yet
+            tokens = min(tokens, remaining)
+            reset_at = parse_reset_time(reset, now) if reset is not None else None
+            if remaining <= 0 and reset_at:
+                logging.warning(f"Rate limit quota for '{self.name}' used up, pausing until it resets in {reset_at - now:.0f}s")
+                blocked_until = max(blocked_until, reset_at)
+            return tokens, blocked_until, None
+        self.update_bucket(change)
+
+    def get_retry_delay(self, attempt, headers=None, status_code=None):
+        # How long to wait before retrying a failed request. A 429 pauses every caller of the
+        # bucket for that long, not only this one.
+        if headers is not None:
+            self.update_from_headers(headers)
+        delay = get_backoff_delay(attempt, get_retry_after(headers))
+        if status_code == 429:
+            self.pause(delay)
+        return delay
@@ -0,0 +1,76 @@
+import os
+import json
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from moviepy.editor import TextClip
+from utility.utils import DIRECTORY_CACHE, ensure_directory_exists, write_file_atomic
+from utility.render.caption_style import VIDEO_SIZE, CAPTION_STYLE
+
+DIRECTORY_CACHE_CAPTIONS = os.path.join(DIRECTORY_CACHE, "captions")
+
+def get_caption_cache_path(text, style=CAPTION_STYLE, size=VIDEO_SIZE):
+    key = json.dumps([text, style, list(size)], sort_keys=True)
+    return os.path.join(DIRECTORY_CACHE_CAPTIONS, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+def load_cached_caption(cache_path):
+    try:
+        with open(cache_path + ".json") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def rasterize_caption(text, style=CAPTION_STYLE, size=VIDEO_SIZE):
+    cache_path = get_caption_cache_path(text, style, size)
+    cached = load_cached_caption(cache_path)
+    if cached is not None:
+        return cached
+
+    text_clip = TextClip(txt=text, method='caption', size=size, **style)
+    rgb = text_clip.get_frame(0)
+    alpha = text_clip.mask.get_frame(0)
+
+    # Keep only the rectangle that has any coverage, plus where it sits in the frame
+    rows = np.flatnonzero(alpha.max(axis=1) > 0)
+    columns = np.flatnonzero(alpha.max(axis=0) > 0)
+    if not len(rows):
+        sprite = {"path": None, "x": 0, "y": 0}
+    else:
+        top, bottom, left, right = rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+        rgba = np.dstack([rgb[top:bottom, left:right], np.round(alpha[top:bottom, left:right] * 255)]).astype(np.uint8)
+        ensure_directory_exists(DIRECTORY_CACHE_CAPTIONS)
+        temp_png = f"{cache_path}.{os.getpid()}.tmp.png"
+        Image.fromarray(rgba, "RGBA").save(temp_png)
+        os.replace(temp_png, cache_path + ".png")
+        sprite = {"path": cache_path + ".png", "x": int(left), "y": int(top)}
+
+    # The sidecar is written last, so a caption only counts as cached once its image exists
+    write_file_atomic(cache_path + ".json", json.dumps(sprite))
+    return sprite
+
+def prerender_captions(timed_captions, style=CAPTION_STYLE, size=VIDEO_SIZE, max_workers=None):
+    sprites = {}
+    missing = []
+    for text in dict.fromkeys(text for _, text in timed_captions):
+        cached = load_cached_caption(get_caption_cache_path(text, style, size))
+        if cached is not None:
+            sprites[text] = cached
+        else:
+            missing.append(text)
+
+    if missing:
+        logging.info(f"Rasterizing {len(missing)} captions ({len(sprites)} cached)")
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {text: executor.submit(rasterize_caption, text, style, size) for text in missing}
+            for text, future in futures.items():
+                try:
+                    sprites[text] = future.result()
+                except Exception as e:
+                    logging.error(f"Error rasterizing caption '{text}': {str(e)}")
+    return sprites
+
+def load_caption_sprite(sprite):
+    rgba = np.asarray(Image.open(sprite["path"]).convert("RGBA"))
+    return rgba[:, :, :3], rgba[:, :, 3] / 255.0
@@ -0,0 +1,70 @@
+from bisect import bisect_right
+import numpy as np
+from utility.render.caption_style import VIDEO_SIZE
+from utility.render.caption_cache import prerender_captions, load_caption_sprite
+
+class CaptionOverlay:
+    # Blends caption sprites straight into each rendered frame. Only the sprite's bounding box is
+    # touched, the blend runs in preallocated buffers, and the layers covering t are found through an
+    # interval index instead of asking every caption clip whether it is playing.
+
+    def __init__(self, layers, frame_size=VIDEO_SIZE):
+        width, height = frame_size
+        self.layers = []
+        for start, end, x, y, rgb, alpha in sorted(layers, key=lambda layer: layer[0]):
+            # Clip sprites to the frame once so blending never needs bounds checks
+            left, top = max(x, 0), max(y, 0)
+            right, bottom = min(x + rgb.shape[1], width), min(y + rgb.shape[0], height)
+            if right <= left or bottom <= top or end <= start:
+                continue
+            # float64 like MoviePy's blit, so every product and sum rounds exactly as it does there
+            alpha = alpha[top - y:bottom - y, left - x:right - x, None].astype(np.float64)
+            premultiplied = rgb[top - y:bottom - y, left - x:right - x] * alpha
+            self.layers.append((start, end, left, top, premultiplied, 1.0 - alpha))
+
+        self.starts = [layer[0] for layer in self.layers]
+        self.ends = [layer[1] for layer in self.layers]
+        # Running maximum of the end times lets the backward scan stop at the first layer that cannot reach t
+        self.max_ends = np.maximum.accumulate(self.ends).tolist() if self.ends else []
+        max_height = max((layer[4].shape[0] for layer in self.layers), default=0)
+        max_width = max((layer[4].shape[1] for layer in self.layers), default=0)
+        self.buffer = np.empty((max_height, max_width, 3), dtype=np.float64)
+
+    def active_layers(self, t):
+        active = []
+        i = bisect_right(self.starts, t) - 1
+        while i >= 0 and self.max_ends[i] > t:
+            if self.ends[i] > t:
+                active.append(self.layers[i])
+            i -= 1
+        active.reverse()
+        return active
+
+    def blend(self, frame, t):
+        active = self.active_layers(t)
+        if not active:
+            return frame
+        if not frame.flags.writeable:
+            frame = frame.copy()
+        for _, _, x, y, premultiplied, inverse_alpha in active:
+            height, width = premultiplied.shape[:2]
+            region = frame[y:y + height, x:x + width]
+            buffer = self.buffer[:height, :width]
+            np.multiply(region, inverse_alpha, out=buffer)
+            buffer += premultiplied
+            # Truncating matches the uint8 cast in MoviePy's own blit
+            np.copyto(region, buffer, casting='unsafe')
+        return frame
+
+    def apply(self, clip):
+        return clip.fl(lambda get_frame, t: self.blend(get_frame(t), t), apply_to=[])
+
+def build_caption_overlay(timed_captions, offset=0):
+    sprites = prerender_captions(timed_captions)
+    layers = []
+    for (t1, t2), text in timed_captions:
+        sprite = sprites.get(text)
+        if sprite and sprite["path"]:
+            rgb, alpha = load_caption_sprite(sprite)
+            layers.append((t1 - offset, t2 - offset, sprite["x"], sprite["y"], rgb, alpha))
+    return CaptionOverlay(layers)
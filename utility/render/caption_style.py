@@ -0,0 +1,11 @@
+VIDEO_SIZE = (1920, 1080)
+VIDEO_FPS = 30
+
+# TextClip arguments shared by every render backend
+CAPTION_STYLE = {
+    "font": "Courier",
+    "fontsize": 50,
+    "color": "white",
+    "stroke_width": 2,
+    "stroke_color": "black"
+}
@@ -0,0 +1,111 @@
+import os
+import logging
+import subprocess
+import tempfile
+from utility.render.caption_style import VIDEO_SIZE, VIDEO_FPS, CAPTION_STYLE
+from utility.render.ffmpeg_utils import get_ffmpeg_binary, probe_duration
+
+ASS_COLORS = {"white": "&H00FFFFFF", "black": "&H00000000", "yellow": "&H0000FFFF"}
+
+def format_ass_time(seconds):
+    centiseconds = int(round(seconds * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+def escape_ass_text(text):
+    return text.replace("\\", "\\\\").replace("{", "\\{").replace("}", "\\}").replace("\n", "\\N")
+
+def write_ass_subtitles(timed_captions, filename, style=CAPTION_STYLE):
+    width, height = VIDEO_SIZE
+    # Alignment 5 centres the text in the frame, matching a frame-sized TextClip(method='caption')
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {width}",
+        f"PlayResY: {height}",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, OutlineColour, BackColour, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV",
+        f"Style: Caption,{style['font']},{style['fontsize']},{ASS_COLORS.get(style['color'], ASS_COLORS['white'])},"
+        f"{ASS_COLORS.get(style['stroke_color'], ASS_COLORS['black'])},&H00000000,1,{style['stroke_width']},0,5,0,0,0",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Text",
+    ]
+    for (t1, t2), text in timed_captions:
+        lines.append(f"Dialogue: 0,{format_ass_time(t1)},{format_ass_time(t2)},Caption,{escape_ass_text(text)}")
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+def escape_filter_path(path):
+    return path.replace("\\", "/").replace(":", "\\:").replace("'", "\\'")
+
+def build_timeline(background_video_data, duration):
+    # Lay the background segments end to end, filling uncovered time with black
+    pieces = []
+    position = 0.0
+    for (t1, t2), video_filename in sorted(background_video_data, key=lambda item: item[0][0]):
+        t1, t2 = max(t1, position), min(t2, duration)
+        if t2 <= t1:
+            continue
+        if t1 > position:
+            pieces.append((t1 - position, None))
+        pieces.append((t2 - t1, video_filename))
+        position = t2
+    if position < duration:
+        pieces.append((duration - position, None))
+    return pieces
+
+def build_filter_graph(pieces, subtitles_filename):
+    width, height = VIDEO_SIZE
+    filters = []
+    labels = []
+    input_index = 0
+    for i, (piece_duration, video_filename) in enumerate(pieces):
+        if video_filename is None:
+            filters.append(f"color=c=black:s={width}x{height}:r={VIDEO_FPS}:d={piece_duration:.3f},setsar=1[v{i}]")
+        else:
+            # Clips shorter than their segment hold their last frame instead of leaving a gap
+            filters.append(
+                f"[{input_index}:v]fps={VIDEO_FPS},scale={width}:{height}:force_original_aspect_ratio=increase,"
+                f"crop={width}:{height},setsar=1,tpad=stop_mode=clone:stop_duration={piece_duration:.3f},"
+                f"trim=duration={piece_duration:.3f},setpts=PTS-STARTPTS[v{i}]"
+            )
+            input_index += 1
+        labels.append(f"[v{i}]")
+    filters.append(f"{''.join(labels)}concat=n={len(pieces)}:v=1:a=0,format=yuv420p[bg]")
+    filters.append(f"[bg]subtitles=filename='{escape_filter_path(subtitles_filename)}'[vout]")
+    return ";".join(filters)
+
+def render_with_ffmpeg(audio_file_path, timed_captions, background_media, output_file_name):
+    duration = probe_duration(audio_file_path)
+    if duration is None:
+        logging.error(f"Could not read audio duration: {audio_file_path}")
+        return None
+
+    # Segments whose clip could not be fetched are missing from background_media and render black
+    pieces = build_timeline(background_media, duration)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file_name))) as work_dir:
+        subtitles_filename = os.path.join(work_dir, "captions.ass")
+        write_ass_subtitles(timed_captions, subtitles_filename)
+
+        command = [get_ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error"]
+        for _, video_filename in pieces:
+            if video_filename is not None:
+                command += ["-i", video_filename]
+        audio_index = sum(1 for _, video_filename in pieces if video_filename is not None)
+        command += ["-i", audio_file_path,
+                    "-filter_complex", build_filter_graph(pieces, subtitles_filename),
+                    "-map", "[vout]", "-map", f"{audio_index}:a",
+                    "-c:v", "libx264", "-r", str(VIDEO_FPS), "-c:a", "aac",
+                    "-t", f"{duration:.3f}", output_file_name]
+
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            logging.error(f"Error rendering final video with ffmpeg: {result.stderr.strip()}")
+            return None
+
+    return output_file_name
@@ -0,0 +1,16 @@
+import os
+import re
+import subprocess
+from imageio_ffmpeg import get_ffmpeg_exe
+
+def get_ffmpeg_binary():
+    return os.environ.get("FFMPEG_BINARY") or get_ffmpeg_exe()
+
+def probe_duration(filename):
+    # ffmpeg prints the container duration on stderr even when it has no output to write
+    result = subprocess.run([get_ffmpeg_binary(), "-hide_banner", "-i", filename], capture_output=True, text=True)
+    match = re.search(r"Duration: (\d+):(\d+):(\d+\.\d+)", result.stderr)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
@@ -0,0 +1,224 @@
+import os
+import re
+import math
+import time
+import stat
+import hashlib
+import logging
+import threading
+import subprocess
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from filelock import FileLock, Timeout
+from utility.utils import DIRECTORY_CACHE, CLIP_FETCH_MODE, ensure_directory_exists
+from utility.render.ffmpeg_utils import get_ffmpeg_binary
+from utility.rate_limiter import RateLimiter, MEDIA_RATE_LIMIT
+from utility.render.media_leases import get_leased_paths
+
+DIRECTORY_CACHE_MEDIA = os.path.join(DIRECTORY_CACHE, "media")
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+# Covers the moment between a clip landing in the cache and its job leasing it
+MEDIA_CACHE_GRACE_SECONDS = int(os.environ.get("MEDIA_CACHE_GRACE_SECONDS", 15 * 60))
+# Entries share a fixed set of lock files picked by a hash of their name. Lock files are never
+# deleted (a deleted lock file would let two processes hold "the same" lock), so striping is what
+# keeps their number bounded; two clips on one stripe only means one waits for the other's fetch.
+LOCK_STRIPE_DIGITS = 3
+# Query parameters that sign or expire a link rather than pick the file; everything else, such as
+# the profile_id of a Vimeo-hosted rendition, stays in the cache key
+SIGNATURE_PARAMETERS = {"s", "signature", "sig", "token", "expires", "oauth2_token_id"}
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 30
+POOL_SIZE = 16
+DOWNLOAD_RETRIES = 3
+MEDIA_LIMITER = RateLimiter("media", MEDIA_RATE_LIMIT)
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = USER_AGENT
+            _session = session
+        return _session
+
+def get_canonical_url(url):
+    # Signatures change between API responses for the same file
+    parts = urlsplit(url)
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if key.lower() not in SIGNATURE_PARAMETERS)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+def get_cache_path(url, span_seconds=None):
+    canonical_url = get_canonical_url(url)
+    digest = hashlib.sha256(canonical_url.encode("utf-8")).hexdigest()[:16]
+    match = re.search(r'/(?:video-files|external)/(\d+)', canonical_url)
+    key = f"{match.group(1)}-{digest}" if match else digest
+    if span_seconds is not None:
+        key += f"-span{span_seconds}"
+    extension = os.path.splitext(urlsplit(canonical_url).path)[1] or ".mp4"
+    return os.path.join(DIRECTORY_CACHE_MEDIA, key + extension)
+
+def get_lock_path(path):
+    directory, filename = os.path.split(path)
+    stripe = hashlib.sha256(filename.encode("utf-8")).hexdigest()[:LOCK_STRIPE_DIGITS]
+    return os.path.join(directory, "locks", stripe + ".lock")
+
+def lock_cache_entry(path, timeout=-1):
+    ensure_directory_exists(os.path.join(os.path.dirname(path), "locks"))
+    return FileLock(get_lock_path(path), timeout=timeout)
+
+def stream_download(url, filename):
+    for attempt in range(DOWNLOAD_RETRIES):
+        MEDIA_LIMITER.acquire()
+        try:
+            return stream_download_attempt(url, filename)
+        except requests.RequestException as e:
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            response = e.response
+            delay = MEDIA_LIMITER.get_retry_delay(
+                attempt, getattr(response, "headers", None), getattr(response, "status_code", None))
+            logging.warning(f"Download of {url} failed (attempt {attempt + 1}/{DOWNLOAD_RETRIES}), retrying in {delay:.1f}s: {str(e)}")
+            time.sleep(delay)
+
+def stream_download_attempt(url, filename):
+    # Bytes land in a .part file first, which a later attempt resumes with a Range request
+    partial_filename = filename + ".part"
+    offset = os.path.getsize(partial_filename) if os.path.exists(partial_filename) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    with get_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if offset and response.status_code == 416:
+            os.remove(partial_filename)
+            return stream_download_attempt(url, filename)
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            logging.info(f"Server ignored range request, restarting download: {url}")
+            offset = 0
+        with open(partial_filename, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+    os.replace(partial_filename, filename)
+
+def is_cache_entry(filename):
+    return not filename.endswith((".part", ".lock", ".tmp", ".part.mp4"))
+
+def remove_cache_entry(path):
+    # Holding the entry's lock keeps eviction away from a clip that is being fetched right now;
+    # a busy entry is skipped rather than waited for
+    try:
+        with lock_cache_entry(path, timeout=0):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return True
+    except Timeout:
+        return False
+
+def evict_media_cache(max_bytes=MEDIA_CACHE_MAX_BYTES, keep=(), directory=DIRECTORY_CACHE_MEDIA):
+    # Every use of an entry refreshes its mtime. Clips leased by a job stay put until its render is
+    # done with them, and so does anything fetched within the grace period, before its job leases it.
+    recently_used = time.time() - MEDIA_CACHE_GRACE_SECONDS
+    leased = get_leased_paths()
+    entries = []
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if (not stat.S_ISREG(info.st_mode) or not is_cache_entry(filename) or path in keep
+                or info.st_mtime >= recently_used or os.path.abspath(path) in leased):
+            continue
+        entries.append((info.st_mtime, info.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        if remove_cache_entry(path):
+            total_bytes -= size
+            logging.info(f"Evicted cached media: {path}")
+
+def get_cached_media(url):
+    ensure_directory_exists(DIRECTORY_CACHE_MEDIA)
+    path = get_cache_path(url)
+    # Concurrent jobs asking for the same clip wait for a single download
+    with lock_cache_entry(path):
+        if os.path.exists(path):
+            # mtime doubles as the LRU timestamp
+            os.utime(path, None)
+            logging.info(f"Media cache hit: {url}")
+            return path
+        try:
+            stream_download(url, path)
+        except requests.RequestException as e:
+            logging.error(f"Error downloading file from {url}: {str(e)}")
+            return None
+    logging.info(f"Downloaded {url}: {os.path.getsize(path)} bytes")
+    evict_media_cache(keep=(path,))
+    return path
+
+def supports_range_requests(url):
+    try:
+        response = get_session().head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+        return response.ok and response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    except requests.RequestException:
+        return False
+
+def fetch_span(url, span_seconds, filename):
+    # ffmpeg reads the http input with range requests, so seeking with -ss/-t and stream-copying
+    # pulls only the header and the bytes for the requested span instead of the whole file
+    temp_filename = filename + ".part.mp4"
+    MEDIA_LIMITER.acquire()
+    command = [get_ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+               "-user_agent", USER_AGENT, "-ss", "0", "-t", str(span_seconds), "-i", url,
+               "-map", "0:v:0", "-c", "copy", "-movflags", "+faststart", temp_filename]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        logging.error(f"Error fetching {span_seconds}s span of {url}: {result.stderr.strip()}")
+        return False
+    os.replace(temp_filename, filename)
+    return True
+
+def get_cached_media_span(url, duration):
+    # Whole seconds plus one of headroom, so a stream-copied cut that stops on an earlier packet
+    # still covers the segment, and nearby durations share a cache entry
+    span_seconds = math.ceil(duration) + 1
+    full_path = get_cache_path(url)
+    if os.path.exists(full_path):
+        os.utime(full_path, None)
+        return full_path
+
+    ensure_directory_exists(DIRECTORY_CACHE_MEDIA)
+    path = get_cache_path(url, span_seconds)
+    with lock_cache_entry(path):
+        if os.path.exists(path):
+            os.utime(path, None)
+            logging.info(f"Media cache hit: {url} ({span_seconds}s span)")
+            return path
+        if not supports_range_requests(url) or not fetch_span(url, span_seconds, path):
+            logging.info(f"Falling back to a full download: {url}")
+            path = None
+    if path is None:
+        return get_cached_media(url)
+    logging.info(f"Fetched {span_seconds}s span of {url}: {os.path.getsize(path)} bytes")
+    evict_media_cache(keep=(path,))
+    return path
+
+def get_clip_media(url, duration):
+    if CLIP_FETCH_MODE == "span":
+        return get_cached_media_span(url, duration)
+    return get_cached_media(url)
@@ -0,0 +1,51 @@
+import os
+import time
+import sqlite3
+import threading
+from utility.utils import DIRECTORY_CACHE, ensure_directory_exists
+
+# A job leases every clip it resolves until its render is done with them, and cache eviction skips
+# leased files. Leases expire, so a job that dies without releasing them does not pin its clips forever.
+MEDIA_LEASE_PATH = os.environ.get("MEDIA_LEASE_PATH", os.path.join(DIRECTORY_CACHE, "media_leases.sqlite3"))
+MEDIA_LEASE_SECONDS = int(os.environ.get("MEDIA_LEASE_SECONDS", 6 * 3600))
+
+_local = threading.local()
+
+def get_connection(database):
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    if database not in connections:
+        ensure_directory_exists(os.path.dirname(os.path.abspath(database)))
+        connection = sqlite3.connect(database, timeout=60, isolation_level=None)
+        connection.execute("""CREATE TABLE IF NOT EXISTS leases (
+            path TEXT NOT NULL,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (path, holder)
+        )""")
+        connections[database] = connection
+    return connections[database]
+
+def lease_media(holder, paths, seconds=MEDIA_LEASE_SECONDS, database=MEDIA_LEASE_PATH):
+    # Leasing a path again extends the holder's lease on it
+    connection = get_connection(database)
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute("DELETE FROM leases WHERE expires_at <= ?", (now,))
+        connection.executemany(
+            "INSERT OR REPLACE INTO leases (path, holder, expires_at) VALUES (?, ?, ?)",
+            [(os.path.abspath(path), holder, now + seconds) for path in paths])
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+def release_media(holder, database=MEDIA_LEASE_PATH):
+    get_connection(database).execute("DELETE FROM leases WHERE holder = ?", (holder,))
+
+def get_leased_paths(database=MEDIA_LEASE_PATH):
+    rows = get_connection(database).execute(
+        "SELECT DISTINCT path FROM leases WHERE expires_at > ?", (time.time(),)).fetchall()
+    return {path for path, in rows}
@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+import logging
+import subprocess
+from utility.utils import DIRECTORY_CACHE, ensure_directory_exists
+from utility.render.caption_style import VIDEO_SIZE, VIDEO_FPS
+from utility.render.ffmpeg_utils import get_ffmpeg_binary
+from utility.render.media_cache import get_clip_media, evict_media_cache, lock_cache_entry
+
+DIRECTORY_CACHE_MEZZANINE = os.path.join(DIRECTORY_CACHE, "mezzanine")
+MEZZANINE_CACHE_MAX_BYTES = int(os.environ.get("MEZZANINE_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+# Transcode every downloaded clip once into the output profile so renders never resample it again
+MEZZANINE_ENABLED = os.environ.get("MEZZANINE_CACHE", "") not in ("", "0", "false")
+
+MEZZANINE_PROFILE = {
+    "width": VIDEO_SIZE[0],
+    "height": VIDEO_SIZE[1],
+    "fps": VIDEO_FPS,
+    "gop": VIDEO_FPS,
+    "codec": "libx264",
+    "preset": "veryfast",
+    "crf": 18
+}
+
+def get_mezzanine_path(source_filename, profile=MEZZANINE_PROFILE):
+    # Source cache files are already named by Pexels id and URL digest
+    source_key = os.path.splitext(os.path.basename(source_filename))[0]
+    profile_key = hashlib.sha256(json.dumps(profile, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(DIRECTORY_CACHE_MEZZANINE, f"{source_key}-{profile_key}.mp4")
+
+def transcode_mezzanine(source_filename, output_filename, profile=MEZZANINE_PROFILE):
+    width, height = profile["width"], profile["height"]
+    temp_filename = output_filename + ".part.mp4"
+    # A fixed GOP with scene-cut keyframes disabled puts a keyframe at 0 and at every gop frames,
+    # so later cuts on whole seconds land on keyframes
+    command = [get_ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error", "-i", source_filename,
+               "-map", "0:v:0", "-an",
+               "-vf", f"fps={profile['fps']},scale={width}:{height}:force_original_aspect_ratio=increase,crop={width}:{height},setsar=1",
+               "-c:v", profile["codec"], "-preset", profile["preset"], "-crf", str(profile["crf"]), "-pix_fmt", "yuv420p",
+               "-g", str(profile["gop"]), "-keyint_min", str(profile["gop"]), "-sc_threshold", "0",
+               "-movflags", "+faststart", temp_filename]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        logging.error(f"Error transcoding {source_filename}: {result.stderr.strip()}")
+        return False
+    os.replace(temp_filename, output_filename)
+    return True
+
+def get_mezzanine(source_filename, profile=MEZZANINE_PROFILE):
+    ensure_directory_exists(DIRECTORY_CACHE_MEZZANINE)
+    path = get_mezzanine_path(source_filename, profile)
+    with lock_cache_entry(path):
+        if os.path.exists(path):
+            os.utime(path, None)
+            return path
+        if not transcode_mezzanine(source_filename, path, profile):
+            return None
+    logging.info(f"Normalized clip cached: {path}")
+    evict_media_cache(MEZZANINE_CACHE_MAX_BYTES, keep=(path,), directory=DIRECTORY_CACHE_MEZZANINE)
+    return path
+
+def prepare_source_clip(source_filename):
+    if not MEZZANINE_ENABLED:
+        return source_filename
+    return get_mezzanine(source_filename) or source_filename
+
+def get_prepared_clip(url, duration):
+    # Download, then normalize; each clip runs this in its own worker so transcodes overlap other downloads
+    source_filename = get_clip_media(url, duration)
+    if not source_filename:
+        return source_filename
+    return prepare_source_clip(source_filename)
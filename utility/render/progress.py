@@ -0,0 +1,28 @@
+import sys
+import json
+from proglog import ProgressBarLogger
+
+# MoviePy names its frame loop "t" and its audio loop "chunk"
+RENDER_BARS = {"t": "frames", "chunk": "audio"}
+
+class RenderProgressLogger(ProgressBarLogger):
+    # Turns MoviePy's proglog bar updates into (phase, index, total) callbacks, forwarding at most
+    # one update per percent so listeners are not flooded with one event per frame
+
+    def __init__(self, on_progress):
+        super().__init__()
+        self.on_progress = on_progress
+        self.last_percent = {}
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if attr != "index" or bar not in RENDER_BARS:
+            return
+        total = self.bars[bar].get("total") or 0
+        percent = int(100 * value / total) if total else 0
+        if percent != self.last_percent.get(bar):
+            self.last_percent[bar] = percent
+            self.on_progress(RENDER_BARS[bar], value, total)
+
+def write_progress_line(phase, index, total, stream=sys.stdout):
+    stream.write(json.dumps({"event": "progress", "phase": phase, "index": index, "total": total}) + "\n")
+    stream.flush()
@@ -1,21 +1,24 @@
 import os
+import shutil
 import tempfile
 import platform
 import subprocess
-from moviepy.editor import (AudioFileClip, CompositeVideoClip, TextClip, VideoFileClip, concatenate_videoclips)
+from moviepy.editor import (AudioFileClip, ColorClip, CompositeVideoClip, VideoFileClip)
 import requests
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from utility.render.media_cache import stream_download
+from utility.render.mezzanine import get_prepared_clip
+from utility.render.media_leases import lease_media
+from utility.render.caption_style import VIDEO_SIZE, VIDEO_FPS
+from utility.render.caption_cache import prerender_captions
+from utility.render.caption_overlay import build_caption_overlay
+from utility.render.ffmpeg_backend import render_with_ffmpeg
+from utility.render.ffmpeg_utils import get_ffmpeg_binary, probe_duration
 
 def download_file(url, filename):
     try:
-        with open(filename, 'wb') as f:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-            }
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            f.write(response.content)
+        stream_download(url, filename)
         return True
     except requests.RequestException as e:
         logging.error(f"Error downloading file from {url}: {str(e)}")
@@ -32,34 +35,65 @@ def get_program_path(program_name):
     program_path = search_program(program_name)
     return program_path
 
-def get_output_media(audio_file_path, timed_captions, background_video_data, video_server):
-    OUTPUT_FILE_NAME = "rendered_video.mp4"
+def load_background_clip(video_filename, t1, t2, source_start=0, offset=0):
+    try:
+        video_clip = VideoFileClip(video_filename).subclip(source_start, source_start + t2-t1)
+        return video_clip.set_start(t1 - offset).set_end(t2 - offset)
+    except Exception as e:
+        logging.error(f"Error processing video clip: {str(e)}")
+        return None
+
+def resolve_background_media(background_video_data, holder=None):
+    def resolve(item):
+        (t1, t2), video_url = item
+        if not video_url:
+            return None
+        video_filename = get_prepared_clip(video_url, t2 - t1)
+        if not video_filename:
+            logging.warning(f"Failed to download video from {video_url}")
+            return None
+        if holder:
+            # Leased as soon as it is ready, so eviction cannot take it while later clips download
+            lease_media(holder, [video_filename])
+        return [[t1, t2], video_filename]
+
+    with ThreadPoolExecutor() as executor:
+        return [item for item in executor.map(resolve, background_video_data) if item]
+
+def compose_video(background_clips, timed_captions, duration, offset=0):
+    if not background_clips:
+        background_clips = [ColorClip(VIDEO_SIZE, color=(0, 0, 0), duration=duration)]
+    video = CompositeVideoClip(background_clips, size=VIDEO_SIZE).set_duration(duration)
+    # Captions are blended into the composited frame rather than composited as clip layers
+    return build_caption_overlay(timed_captions, offset=offset).apply(video)
+
+def configure_imagemagick():
     magick_path = get_program_path("magick")
     logging.info(f"ImageMagick path: {magick_path}")
     if magick_path:
         os.environ['IMAGEMAGICK_BINARY'] = magick_path
     else:
         os.environ['IMAGEMAGICK_BINARY'] = '/usr/bin/convert'
+
+def get_output_media(audio_file_path, timed_captions, background_media, video_server, render_backend="moviepy", render_slices=1, context=None, logger=None):
+    # background_media holds the local clip files from resolve_background_media, so the render
+    # itself never goes to the network
+    output_file_name = context.output_file if context else "rendered_video.mp4"
+    if render_backend == "ffmpeg":
+        return render_with_ffmpeg(audio_file_path, timed_captions, background_media, output_file_name)
+
+    configure_imagemagick()
+    if render_slices > 1:
+        return render_in_slices(audio_file_path, timed_captions, background_media, output_file_name, render_slices)
     
     visual_clips = []
     
     def process_video(item):
-        (t1, t2), video_url = item
-        if video_url:
-            video_filename = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4").name
-            if download_file(video_url, video_filename):
-                try:
-                    video_clip = VideoFileClip(video_filename).subclip(0, t2-t1)
-                    video_clip = video_clip.set_start(t1).set_end(t2)
-                    return video_clip
-                except Exception as e:
-                    logging.error(f"Error processing video clip: {str(e)}")
-            else:
-                logging.warning(f"Failed to download video from {video_url}")
-        return None
+        (t1, t2), video_filename = item
+        return load_background_clip(video_filename, t1, t2)
     
     with ThreadPoolExecutor() as executor:
-        future_to_video = {executor.submit(process_video, item): item for item in background_video_data}
+        future_to_video = {executor.submit(process_video, item): item for item in background_media}
         for future in as_completed(future_to_video):
             video_clip = future.result()
             if video_clip:
@@ -71,37 +105,104 @@ def get_output_media(audio_file_path, timed_captions, background_video_data, vid
         logging.error(f"Error loading audio file: {str(e)}")
         return None
 
-    for (t1, t2), text in timed_captions:
-        try:
-            text_clip = TextClip(txt=text, fontsize=50, color="white", stroke_width=2, stroke_color="black", method='caption', size=(1920, 1080))
-            text_clip = text_clip.set_start(t1).set_end(t2).set_position(('center', 'bottom'))
-            visual_clips.append(text_clip)
-        except Exception as e:
-            logging.error(f"Error creating text clip: {str(e)}")
-
     try:
-        video = CompositeVideoClip(visual_clips, size=(1920, 1080))
+        video = compose_video(visual_clips, timed_captions, audio_clip.duration)
         video = video.set_audio(audio_clip)
-        video = video.set_duration(audio_clip.duration)
 
-        video.write_videofile(OUTPUT_FILE_NAME, codec='libx264', audio_codec='aac', fps=30, threads=4, logger=None)
+        # MoviePy otherwise muxes through a temp audio file named after the output in the working directory
+        video.write_videofile(output_file_name, codec='libx264', audio_codec='aac', fps=VIDEO_FPS, threads=4, logger=logger,
+                              temp_audiofile=os.path.splitext(output_file_name)[0] + "_temp_audio.m4a")
     except Exception as e:
         logging.error(f"Error rendering final video: {str(e)}")
         return None
-    
-    # Clean up downloaded files
-    for clip in visual_clips:
-        if isinstance(clip, VideoFileClip) and os.path.exists(clip.filename):
-            os.remove(clip.filename)
 
-    return OUTPUT_FILE_NAME
+    # Downloaded clips stay in the media cache for later jobs
+    return output_file_name
+
+def split_timeline(background_media, duration, slice_count):
+    # Cut only where a background clip starts, snapped to the frame grid so every slice is a whole
+    # number of frames and the concatenated slices stay in sync with the audio
+    boundaries = sorted({round(t1 * VIDEO_FPS) / VIDEO_FPS for (t1, _), _ in background_media if 0 < t1 < duration})
+    cuts = []
+    for k in range(1, slice_count):
+        target = duration * k / slice_count
+        candidates = [t for t in boundaries if t not in cuts and (not cuts or t > cuts[-1])]
+        if candidates:
+            cuts.append(min(candidates, key=lambda t: abs(t - target)))
+    edges = [0.0] + cuts + [duration]
+    return [(start, end) for start, end in zip(edges, edges[1:]) if end > start]
 
-def combine_video_segments(segment_videos):
+def render_slice(start, end, background_media, timed_captions, output_file_name):
+    visual_clips = []
+    for (t1, t2), video_filename in background_media:
+        clip_start, clip_end = max(t1, start), min(t2, end)
+        if clip_end > clip_start:
+            # Cuts are snapped to frames, so a clip can spill a fraction of a frame into the next slice
+            video_clip = load_background_clip(video_filename, clip_start, clip_end, source_start=clip_start - t1, offset=start)
+            if video_clip:
+                visual_clips.append(video_clip)
+
+    # Likewise a caption crossing a cut is split between the two slices, which looks identical once joined
+    slice_captions = [((max(t1, start), min(t2, end)), text) for (t1, t2), text in timed_captions if t1 < end and t2 > start]
+
+    video = compose_video(visual_clips, slice_captions, end - start, offset=start)
+    video.write_videofile(output_file_name, codec='libx264', fps=VIDEO_FPS, threads=4, audio=False, logger=None)
+    return output_file_name
+
+def render_in_slices(audio_file_path, timed_captions, background_media, output_file_name, render_slices):
+    duration = probe_duration(audio_file_path)
+    if duration is None:
+        logging.error(f"Could not read audio duration: {audio_file_path}")
+        return None
+
+    # Rasterize every caption once up front so the slice workers only read the cache
+    prerender_captions(timed_captions)
+    slices = split_timeline(background_media, duration, render_slices)
+    logging.info(f"Rendering {len(slices)} slices in parallel")
+
+    slice_dir = tempfile.mkdtemp(prefix="render_slices_", dir=os.path.dirname(os.path.abspath(output_file_name)))
     try:
-        clips = [VideoFileClip(video) for video in segment_videos]
-        final_clip = concatenate_videoclips(clips)
-        final_clip.write_videofile("final_video.mp4", codec='libx264', audio_codec='aac', threads=4, logger=None)
-        return "final_video.mp4"
+        slice_files = [os.path.join(slice_dir, f"slice_{i:04d}.mp4") for i in range(len(slices))]
+        with ProcessPoolExecutor(max_workers=len(slices)) as executor:
+            futures = [executor.submit(render_slice, start, end, background_media, timed_captions, slice_file)
+                       for (start, end), slice_file in zip(slices, slice_files)]
+            for future in futures:
+                future.result()
+        # The audio track is muxed once over the joined slices so there are no seams
+        return combine_video_segments(slice_files, output_file_name, audio_file_path=audio_file_path)
+    except Exception as e:
+        logging.error(f"Error rendering video slices: {str(e)}")
+        return None
+    finally:
+        shutil.rmtree(slice_dir, ignore_errors=True)
+
+def combine_video_segments(segment_videos, output_file_name=None, audio_file_path=None, context=None):
+    if output_file_name is None:
+        output_file_name = context.path("final_video.mp4") if context else "final_video.mp4"
+    # The concat demuxer joins segments encoded with the same settings without re-encoding them
+    list_file = None
+    try:
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, dir=os.path.dirname(os.path.abspath(output_file_name))) as f:
+            for video in segment_videos:
+                escaped_path = os.path.abspath(video).replace("'", "'\\''")
+                f.write(f"file '{escaped_path}'\n")
+            list_file = f.name
+
+        command = [get_ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error",
+                   "-f", "concat", "-safe", "0", "-i", list_file]
+        if audio_file_path:
+            command += ["-i", audio_file_path, "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "aac", "-shortest"]
+        else:
+            command += ["-c", "copy"]
+        command.append(output_file_name)
+
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip())
+        return output_file_name
     except Exception as e:
         logging.error(f"Error combining video segments: {str(e)}")
         return None
+    finally:
+        if list_file and os.path.exists(list_file):
+            os.remove(list_file)
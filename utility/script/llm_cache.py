@@ -0,0 +1,196 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import argparse
+import threading
+from utility.utils import DIRECTORY_CACHE, DIRECTORY_LOG_GPT, ensure_directory_exists
+from utility.rate_limiter import RateLimiter, LLM_RATE_LIMIT
+
+LLM_CACHE_PATH = os.path.join(DIRECTORY_CACHE, "llm_responses.sqlite3")
+# Replay mode answers from the cache only, so a re-run is deterministic and never calls the model
+LLM_REPLAY = os.environ.get("LLM_REPLAY", "") not in ("", "0", "false")
+# Turns the cache off entirely, e.g. to sample fresh answers at temperature 1
+LLM_CACHE_DISABLED = os.environ.get("LLM_CACHE", "") in ("0", "false")
+LLM_MAX_RETRIES = 4
+# One bucket for every model and provider; set LLM_RATE_LIMIT to the account's requests-per-minute
+LLM_LIMITER = RateLimiter("llm", LLM_RATE_LIMIT)
+RETRYABLE_ERRORS = ("APIConnectionError", "APITimeoutError")
+
+_local = threading.local()
+
+class LLMCacheMiss(LookupError):
+    pass
+
+def get_connection():
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        ensure_directory_exists(os.path.dirname(LLM_CACHE_PATH) or ".")
+        connection = sqlite3.connect(LLM_CACHE_PATH, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+            cache_key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            source TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )""")
+        _local.connection = connection
+    return connection
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def get_cache_key(model, system_prompt, user_content, temperature):
+    return json.dumps([model, hash_text(system_prompt), hash_text(user_content), temperature])
+
+def get_seed_key(seed):
+    # Request logs only record the script a call was made for, not the full request, so imported
+    # entries are keyed on that alone and answer any call that passes the same seed
+    return json.dumps(["seed", hash_text(seed)])
+
+def get_cached_response(cache_key):
+    row = get_connection().execute("SELECT response FROM responses WHERE cache_key = ?", (cache_key,)).fetchone()
+    return row[0] if row else None
+
+def store_response(cache_key, response, source="api"):
+    try:
+        with get_connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (cache_key, response, source, created_at) VALUES (?, ?, ?, ?)",
+                (cache_key, response, source, time.time()))
+    except sqlite3.Error as e:
+        logging.error(f"Error writing LLM response cache: {str(e)}")
+
+def cached_completion(client, model, system_prompt, user_content, temperature=None, seed=None, validate=None):
+    if LLM_CACHE_DISABLED:
+        return request_completion(client, model, system_prompt, user_content, temperature)
+
+    cache_key = get_cache_key(model, system_prompt, user_content, temperature)
+    cached = get_cached_response(cache_key)
+    if cached is None and seed is not None:
+        # Imported entries were never validated when they were stored
+        cached = get_cached_response(get_seed_key(seed))
+        if cached is not None and validate is not None and not validate(cached):
+            cached = None
+    if cached is not None:
+        logging.info(f"LLM cache hit for {model}")
+        return cached
+    if LLM_REPLAY:
+        raise LLMCacheMiss(f"Replay mode: no cached {model} response for this request")
+
+    content = request_completion(client, model, system_prompt, user_content, temperature)
+    if content and (validate is None or validate(content)):
+        store_response(cache_key, content)
+    return content
+
+def stream_completion(client, model, system_prompt, user_content, temperature=None, validate=None):
+    # Yields the answer as it arrives. Shares cached_completion's cache, so a cached answer comes
+    # back as a single piece and a streamed one is stored once it is complete and valid.
+    cache_key = get_cache_key(model, system_prompt, user_content, temperature)
+    if not LLM_CACHE_DISABLED:
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            logging.info(f"LLM cache hit for {model}")
+            yield cached
+            return
+        if LLM_REPLAY:
+            raise LLMCacheMiss(f"Replay mode: no cached {model} response for this request")
+
+    request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ],
+        "stream": True
+    }
+    if temperature is not None:
+        request["temperature"] = temperature
+    parts = []
+    for chunk in create_completion(client, request):
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            yield delta
+
+    content = "".join(parts)
+    if not LLM_CACHE_DISABLED and content and (validate is None or validate(content)):
+        store_response(cache_key, content)
+
+def request_completion(client, model, system_prompt, user_content, temperature=None):
+    request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ]
+    }
+    if temperature is not None:
+        request["temperature"] = temperature
+    response = create_completion(client, request)
+    return response.choices[0].message.content
+
+def is_retryable_error(error):
+    status_code = getattr(error, "status_code", None)
+    return status_code == 429 or (status_code or 0) >= 500 or type(error).__name__ in RETRYABLE_ERRORS
+
+def create_completion(client, request):
+    # The SDK's own retries are turned off so that every retry goes through the shared limiter:
+    # a 429 pauses all processes together, and the quota headers of successful calls keep the
+    # bucket in step with the account's real limit. A stream is only retried until it opens.
+    for attempt in range(LLM_MAX_RETRIES):
+        LLM_LIMITER.acquire()
+        try:
+            raw_response = client.with_options(max_retries=0).chat.completions.with_raw_response.create(**request)
+        except Exception as e:
+            if attempt == LLM_MAX_RETRIES - 1 or not is_retryable_error(e):
+                raise
+            response = getattr(e, "response", None)
+            delay = LLM_LIMITER.get_retry_delay(attempt, getattr(response, "headers", None), getattr(e, "status_code", None))
+            logging.warning(f"LLM request failed (attempt {attempt + 1}/{LLM_MAX_RETRIES}), retrying in {delay:.1f}s: {str(e)}")
+            time.sleep(delay)
+            continue
+        LLM_LIMITER.update_from_headers(raw_response.headers)
+        return raw_response.parse()
+
+def find_gpt_log_files(directories):
+    for directory in directories:
+        for root, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                if filename.endswith(".txt"):
+                    yield os.path.join(root, filename)
+
+def import_gpt_logs(directories):
+    imported = 0
+    # Log names start with their timestamp, so the newest answer for a script is stored last and wins
+    for filepath in sorted(find_gpt_log_files(directories), key=os.path.basename):
+        try:
+            with open(filepath) as f:
+                log_entry = json.load(f)
+            query, response = log_entry["query"], log_entry["response"]
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Skipping unreadable log file {filepath}: {str(e)}")
+            continue
+        if isinstance(query, str) and isinstance(response, str) and response:
+            store_response(get_seed_key(query), response, source=f"log:{os.path.basename(filepath)}")
+            imported += 1
+    logging.info(f"Imported {imported} logged LLM responses into {LLM_CACHE_PATH}")
+    return imported
+
+def get_default_log_directories():
+    from utility.pipeline.job_context import DIRECTORY_JOBS
+    return [DIRECTORY_LOG_GPT] + sorted(glob.glob(os.path.join(DIRECTORY_JOBS, "*", DIRECTORY_LOG_GPT)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the LLM response cache.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import-logs", help="Seed the cache from gpt_logs files written by log_response")
+    import_parser.add_argument("directories", nargs="*", help="Log directories to scan (default: .logs/gpt_logs and every job's)")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parser.parse_args()
+    if args.command == "import-logs":
+        import_gpt_logs(args.directories or get_default_log_directories())
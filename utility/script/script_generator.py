@@ -2,13 +2,17 @@ import os
 import json
 import edge_tts
 import asyncio
-import whisper_timestamped as whisper
-from utility.audio.audio_generator import generate_audio
+import re
+import logging
+from utility.audio.audio_generator import generate_audio, generate_audio_streamed, split_sentences
 from utility.captions.timed_captions_generator import generate_timed_captions
 from utility.video.background_video_generator import generate_video_url
-from utility.render.render_engine import get_output_media
+from utility.render.render_engine import get_output_media, resolve_background_media
 from utility.video.video_search_query_generator import getVideoSearchQueriesTimed, merge_empty_intervals
+from utility.pipeline.job_context import JobContext
+from utility.script.llm_cache import cached_completion, stream_completion
 import argparse
+from datetime import datetime
 
 # Determine which API client to use
 if len(os.environ.get("GROQ_API_KEY", "")) > 30:
@@ -21,7 +25,13 @@ else:
     model = "gpt-4o"
     client = OpenAI(api_key=OPENAI_API_KEY)
 
-def generate_script(topic, video_type='short'):
+def is_valid_script_response(content):
+    try:
+        return bool(json.loads(content)["script"])
+    except (ValueError, KeyError, TypeError):
+        return False
+
+def get_prompt(video_type='short'):
     if video_type == 'short':
         prompt = (
             """You are a seasoned content writer for a YouTube Shorts channel, specializing in facts videos. 
@@ -73,21 +83,13 @@ def generate_script(topic, video_type='short'):
             {"script": "The full paragraph script goes here..."}
             """
         )
+    return prompt
 
-
-
-
+def generate_script(topic, video_type='short'):
+    prompt = get_prompt(video_type)
 
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": topic}
-            ]
-        )
-        
-        content = response.choices[0].message.content
+        content = cached_completion(client, model, prompt, topic, validate=is_valid_script_response)
         print("Raw Response:", content)  # Debugging response
         
         if not content or (not content.startswith('{') and not content.startswith('[')):
@@ -105,34 +107,145 @@ def generate_script(topic, video_type='short'):
 
     return script
 
+SCRIPT_VALUE_PATTERN = re.compile(r'"script"\s*:\s*"')
+
+def extract_script_text(partial_content):
+    # Decodes as much of the "script" string value as has arrived: (text, closed), or (None, False)
+    # before the value starts. An escape sequence cut off by the end of a chunk waits for the next.
+    match = SCRIPT_VALUE_PATTERN.search(partial_content)
+    if not match:
+        return None, False
+    raw = partial_content[match.end():]
+    index = 0
+    while index < len(raw):
+        if raw[index] == '"':
+            return json.loads(f'"{raw[:index]}"'), True
+        if raw[index] == '\\':
+            length = 6 if raw[index + 1:index + 2] == 'u' else 2
+            if index + length > len(raw):
+                break
+            index += length
+        else:
+            index += 1
+    return json.loads(f'"{raw[:index]}"'), False
+
+def get_closed_sentences(text):
+    # A sentence is only final once the whitespace after it has arrived; the last piece may still grow
+    return [sentence for sentence in re.split(r'(?<=[.!?])\s+', text.lstrip())[:-1] if sentence]
+
+class ScriptStream:
+    # Publishes the script sentence by sentence while the completion is still arriving, so speech
+    # synthesis can start on the first sentence instead of waiting for the whole answer. Any number
+    # of consumers can subscribe; each one gets every sentence, in order, split exactly as
+    # split_sentences() splits the finished script.
+
+    def __init__(self, topic, video_type='short'):
+        self.topic = topic
+        self.video_type = video_type
+        self.sentences = []
+        self.script = None
+        self.error = None
+        self.finished = False
+        # Replaced on every publish, so a subscriber waits on the one current when it last caught up
+        self.updated = asyncio.Event()
+
+    def publish(self, sentences):
+        self.sentences.extend(sentences)
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    async def run(self):
+        try:
+            deltas = stream_completion(client, model, get_prompt(self.video_type), self.topic, validate=is_valid_script_response)
+            content = ""
+            while True:
+                # The SDK's stream blocks, so each read happens in a thread
+                delta = await asyncio.to_thread(next, deltas, None)
+                if delta is None:
+                    break
+                content += delta
+                text, closed = extract_script_text(content)
+                if text is not None and not closed:
+                    self.publish(get_closed_sentences(text)[len(self.sentences):])
+
+            if not is_valid_script_response(content):
+                raise ValueError(f"Invalid response received from API: {content[:200]}")
+            self.script = json.loads(content)["script"]
+            sentences = split_sentences(self.script)
+            if sentences[:len(self.sentences)] != self.sentences:
+                raise ValueError("Streamed sentences do not match the finished script")
+            self.publish(sentences[len(self.sentences):])
+        except Exception as e:
+            logging.error(f"Error streaming script: {str(e)}")
+            self.script = None
+            self.error = e
+        finally:
+            self.finished = True
+            self.publish([])
+        return self.script
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            updated = self.updated
+            while index < len(self.sentences):
+                yield self.sentences[index]
+                index += 1
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            await updated.wait()
+
+async def generate_script_and_audio(topic, output_filename, video_type='short'):
+    # Streaming counterpart of generate_script followed by generate_audio, with the same results
+    stream = ScriptStream(topic, video_type)
+    runner = asyncio.create_task(stream.run())
+    try:
+        word_boundaries = await generate_audio_streamed(stream.subscribe(), output_filename)
+    finally:
+        script = await runner
+    return script, word_boundaries
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a video from a topic.")
     parser.add_argument("topic", type=str, help="The topic for the video")
     parser.add_argument("--video_type", type=str, choices=['short', 'long'], default='short', help="Type of video to generate")
+    parser.add_argument("--job_dir", type=str, default=None, help="Workspace for this job's files (default: jobs/<timestamp>)")
+    parser.add_argument("--stream", action="store_true", help="Start speech synthesis while the script is still being generated")
 
     args = parser.parse_args()
     SAMPLE_TOPIC = args.topic
-    SAMPLE_FILE_NAME = "audio_tts.wav"
+    context = JobContext(datetime.now().strftime("%Y%m%d_%H%M%S_%f"), args.job_dir)
+    SAMPLE_FILE_NAME = context.audio_file
     VIDEO_SERVER = "pexel"
 
     # Generate the script based on the video type
-    response = generate_script(SAMPLE_TOPIC, args.video_type)
+    word_boundaries = None
+    if args.stream:
+        try:
+            response, word_boundaries = asyncio.run(generate_script_and_audio(SAMPLE_TOPIC, SAMPLE_FILE_NAME, args.video_type))
+        except Exception as e:
+            response = f"Error: {str(e)}"
+    else:
+        response = generate_script(SAMPLE_TOPIC, args.video_type)
     print("Generated Script:", response)
 
     if "Error" in response:
         print("Exiting due to script generation error.")
     else:
-        asyncio.run(generate_audio(response, SAMPLE_FILE_NAME))
+        if word_boundaries is None:
+            word_boundaries = asyncio.run(generate_audio(response, SAMPLE_FILE_NAME))
 
-        timed_captions = generate_timed_captions(SAMPLE_FILE_NAME)
+        timed_captions = generate_timed_captions(SAMPLE_FILE_NAME, word_boundaries=word_boundaries)
         print("Timed Captions:", timed_captions)
 
-        search_terms = getVideoSearchQueriesTimed(response, timed_captions)
+        search_terms = getVideoSearchQueriesTimed(response, timed_captions, context)
         print("Search Terms:", search_terms)
 
         background_video_urls = None
         if search_terms is not None:
-            background_video_urls = generate_video_url(search_terms, VIDEO_SERVER)
+            background_video_urls = generate_video_url(search_terms, VIDEO_SERVER, context)
             print("Background Video URLs:", background_video_urls)
         else:
             print("No background video")
@@ -140,7 +253,8 @@ if __name__ == "__main__":
         background_video_urls = merge_empty_intervals(background_video_urls)
 
         if background_video_urls is not None:
-            video = get_output_media(SAMPLE_FILE_NAME, timed_captions, background_video_urls, VIDEO_SERVER)
+            background_media = resolve_background_media(background_video_urls)
+            video = get_output_media(SAMPLE_FILE_NAME, timed_captions, background_media, VIDEO_SERVER, context=context)
             print("Output Video:", video)
         else:
             print("No video")
@@ -2,6 +2,7 @@ import os
 from datetime import datetime
 import json
 import logging
+import uuid
 
 # Log types
 LOG_TYPE_GPT = "GPT"
@@ -11,11 +12,26 @@ LOG_TYPE_PEXEL = "PEXEL"
 DIRECTORY_LOG_GPT = ".logs/gpt_logs"
 DIRECTORY_LOG_PEXEL = ".logs/pexel_logs"
 
+# cache directory shared across jobs
+DIRECTORY_CACHE = os.environ.get("CACHE_DIR", ".cache")
+
+# "full" downloads the exact 1920x1080 rendition; "span" picks the smallest rendition at or above
+# the output size and fetches only the part of it each segment plays
+CLIP_FETCH_MODE = os.environ.get("CLIP_FETCH_MODE", "full")
+
 def ensure_directory_exists(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-def log_response(log_type, query, response):
+def write_file_atomic(filepath, data):
+    ensure_directory_exists(os.path.dirname(filepath) or ".")
+    temp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+    mode = "wb" if isinstance(data, bytes) else "w"
+    with open(temp_path, mode) as outfile:
+        outfile.write(data)
+    os.replace(temp_path, filepath)
+
+def log_response(log_type, query, response, context=None):
     log_entry = {
         "query": query,
         "response": response,
@@ -30,8 +46,11 @@ def log_response(log_type, query, response):
         logging.error(f"Invalid log type: {log_type}")
         return
 
+    if context is not None:
+        directory = context.log_directory(directory)
     ensure_directory_exists(directory)
-    filename = f'{datetime.now().strftime("%Y%m%d_%H%M%S")}_{log_type.lower()}.txt'
+    # Microseconds and a random suffix keep concurrent calls from writing the same file
+    filename = f'{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}_{uuid.uuid4().hex[:8]}_{log_type.lower()}.txt'
     filepath = os.path.join(directory, filename)
 
     try:
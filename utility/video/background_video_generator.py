@@ -1,86 +1,160 @@
 import os 
+import asyncio
 import requests
-from utility.utils import log_response, LOG_TYPE_PEXEL
+import httpx
+from utility.utils import log_response, LOG_TYPE_PEXEL, CLIP_FETCH_MODE
+from utility.video.search_cache import get_cached_search, store_search, PEXELS_OFFLINE
+from utility.video.clip_assignment import score_candidate, solve_assignment
+from utility.rate_limiter import RateLimiter, PEXELS_RATE_LIMIT
 import logging
 import time
 
 PEXELS_API_KEY = os.environ.get('PEXELS_KEY')
+PEXELS_SEARCH_URL = "https://api.pexels.com/videos/search"
 MAX_RETRIES = 3
-RETRY_DELAY = 2
+MAX_CONCURRENT_SEARCHES = 8
+SEARCH_PAGES = range(1, 4)  # Try up to 3 pages
+PEXELS_LIMITER = RateLimiter("pexels", PEXELS_RATE_LIMIT)
 
-def search_videos(query_string, orientation_landscape=True, page=1):
-    url = "https://api.pexels.com/videos/search"
-    headers = {
-        "Authorization": PEXELS_API_KEY,
+def get_search_headers():
+    return {
+        "Authorization": PEXELS_API_KEY or "",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
     }
-    params = {
+
+def get_search_params(query_string, orientation_landscape=True, page=1):
+    return {
         "query": query_string,
         "orientation": "landscape" if orientation_landscape else "portrait",
         "per_page": 15,
         "page": page
     }
 
+def get_cached_or_offline(params):
+    cached = get_cached_search(params)
+    if cached is None and PEXELS_OFFLINE:
+        logging.warning(f"Offline mode: no cached search results for query: {params['query']}")
+    return cached
+
+def record_search(query_string, params, json_data, context=None):
+    log_response(LOG_TYPE_PEXEL, query_string, json_data, context)
+    return store_search(params, json_data)
+
+def search_videos(query_string, orientation_landscape=True, page=1, context=None):
+    params = get_search_params(query_string, orientation_landscape, page)
+
+    cached = get_cached_or_offline(params)
+    if cached is not None or PEXELS_OFFLINE:
+        return cached
+
     for attempt in range(MAX_RETRIES):
+        PEXELS_LIMITER.acquire()
+        response = None
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = requests.get(PEXELS_SEARCH_URL, headers=get_search_headers(), params=params)
             response.raise_for_status()
-            json_data = response.json()
-            log_response(LOG_TYPE_PEXEL, query_string, json_data)
-            return json_data
+            PEXELS_LIMITER.update_from_headers(response.headers)
+            return record_search(query_string, params, response.json(), context)
         except requests.RequestException as e:
             logging.error(f"Error in API request (attempt {attempt + 1}/{MAX_RETRIES}): {str(e)}")
             if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY)
+                time.sleep(PEXELS_LIMITER.get_retry_delay(
+                    attempt, getattr(response, "headers", None), getattr(response, "status_code", None)))
+            else:
+                logging.error("Max retries reached. Giving up.")
+                return None
+
+async def search_videos_async(client, semaphore, query_string, orientation_landscape=True, page=1, context=None):
+    params = get_search_params(query_string, orientation_landscape, page)
+
+    # The search cache (SQLite) and the response log (a file) block, so they run in threads too
+    cached = await asyncio.to_thread(get_cached_or_offline, params)
+    if cached is not None or PEXELS_OFFLINE:
+        return cached
+
+    for attempt in range(MAX_RETRIES):
+        response = None
+        try:
+            async with semaphore:
+                await PEXELS_LIMITER.acquire_async()
+                response = await client.get(PEXELS_SEARCH_URL, params=params)
+            response.raise_for_status()
+            # The limiter's SQLite updates can block on other processes, so they stay off the event loop
+            await asyncio.to_thread(PEXELS_LIMITER.update_from_headers, response.headers)
+            return await asyncio.to_thread(record_search, query_string, params, response.json(), context)
+        except httpx.HTTPError as e:
+            logging.error(f"Error in API request (attempt {attempt + 1}/{MAX_RETRIES}): {str(e)}")
+            if attempt < MAX_RETRIES - 1:
+                await asyncio.sleep(await asyncio.to_thread(
+                    PEXELS_LIMITER.get_retry_delay, attempt, getattr(response, "headers", None), getattr(response, "status_code", None)))
             else:
                 logging.error("Max retries reached. Giving up.")
                 return None
 
-def getBestVideo(query_string, orientation_landscape=True, used_vids=[], page=1):
-    vids = search_videos(query_string, orientation_landscape, page)
-    
+def get_video_key(link):
+    return link.split('.hd')[0]
+
+def getBestVideo(query_string, orientation_landscape=True, used_vids=(), page=1, context=None):
+    vids = search_videos(query_string, orientation_landscape, page, context)
+    return selectBestVideo(vids, query_string, orientation_landscape, used_vids)
+
+def getCandidateFiles(vids, orientation_landscape=True):
     if vids is None or 'videos' not in vids:
-        logging.warning(f"No valid response for query: {query_string}")
-        return None
+        return []
 
     videos = vids['videos']
 
-    if not videos:
-        logging.warning(f"No videos found for query: {query_string}")
-        return None
-
     if orientation_landscape:
         filtered_videos = [video for video in videos if video['width'] >= 1920 and video['height'] >= 1080 and video['width']/video['height'] == 16/9]
+        target_size = (1920, 1080)
     else:
         filtered_videos = [video for video in videos if video['width'] >= 1080 and video['height'] >= 1920 and video['height']/video['width'] == 16/9]
+        target_size = (1080, 1920)
 
     sorted_videos = sorted(filtered_videos, key=lambda x: abs(15-int(x['duration'])))
 
-    for video in sorted_videos:
-        for video_file in video['video_files']:
-            if orientation_landscape:
-                if video_file['width'] == 1920 and video_file['height'] == 1080:
-                    if not (video_file['link'].split('.hd')[0] in used_vids):
-                        return video_file['link']
-            else:
-                if video_file['width'] == 1080 and video_file['height'] == 1920:
-                    if not (video_file['link'].split('.hd')[0] in used_vids):
-                        return video_file['link']
+    if CLIP_FETCH_MODE == "span":
+        return [(video, video_file) for video in sorted_videos
+                for video_file in [getSmallestRendition(video['video_files'], target_size)] if video_file]
+
+    return [(video, video_file) for video in sorted_videos for video_file in video['video_files']
+            if (video_file['width'], video_file['height']) == target_size]
+
+def getSmallestRendition(video_files, target_size):
+    target_width, target_height = target_size
+    renditions = [video_file for video_file in video_files
+                  if video_file['width'] and video_file['height']
+                  and video_file['width'] >= target_width and video_file['height'] >= target_height]
+    return min(renditions, key=lambda video_file: video_file['width'] * video_file['height'], default=None)
+
+def selectBestVideo(vids, query_string, orientation_landscape=True, used_vids=()):
+    if vids is None or 'videos' not in vids:
+        logging.warning(f"No valid response for query: {query_string}")
+        return None
+
+    if not vids['videos']:
+        logging.warning(f"No videos found for query: {query_string}")
+        return None
+
+    # used_vids is a set of video keys, so each membership check is a hash lookup
+    for video, video_file in getCandidateFiles(vids, orientation_landscape):
+        if get_video_key(video_file['link']) not in used_vids:
+            return video_file['link']
 
     logging.warning(f"No suitable videos found for query: {query_string}")
     return None
 
-def generate_video_url(timed_video_searches, video_server):
+def generate_video_url(timed_video_searches, video_server, context=None):
     timed_video_urls = []
     if video_server == "pexel":
-        used_links = []
+        used_links = set()
         for (t1, t2), search_terms in timed_video_searches:
             url = None
-            for page in range(1, 4):  # Try up to 3 pages
+            for page in SEARCH_PAGES:
                 for query in search_terms:
-                    url = getBestVideo(query, orientation_landscape=True, used_vids=used_links, page=page)
+                    url = getBestVideo(query, orientation_landscape=True, used_vids=used_links, page=page, context=context)
                     if url:
-                        used_links.append(url.split('.hd')[0])
+                        used_links.add(get_video_key(url))
                         break
                 if url:
                     break
@@ -91,3 +165,104 @@ def generate_video_url(timed_video_searches, video_server):
         logging.error(f"Unsupported video server: {video_server}")
 
     return timed_video_urls
+
+def create_search_client(max_concurrent_searches=MAX_CONCURRENT_SEARCHES):
+    limits = httpx.Limits(max_connections=max_concurrent_searches, max_keepalive_connections=max_concurrent_searches)
+    return httpx.AsyncClient(headers=get_search_headers(), limits=limits, timeout=30)
+
+async def generate_video_url_async(timed_video_searches, video_server, max_concurrent_searches=MAX_CONCURRENT_SEARCHES, assignment="greedy", context=None, client=None, on_url=None):
+    # on_url, if given, is awaited with each [[t1, t2], url] in segment order as soon as it is chosen
+    if video_server != "pexel":
+        timed_video_urls = generate_video_url(timed_video_searches, video_server, context)
+        for item in timed_video_urls if on_url else ():
+            await on_url(item)
+        return timed_video_urls
+
+    if client is None:
+        async with create_search_client(max_concurrent_searches) as client:
+            return await select_video_urls_async(client, timed_video_searches, max_concurrent_searches, assignment, context, on_url)
+    # A long-lived caller can pass one client so its warm connections carry over between jobs
+    return await select_video_urls_async(client, timed_video_searches, max_concurrent_searches, assignment, context, on_url)
+
+async def select_video_urls_async(client, timed_video_searches, max_concurrent_searches=MAX_CONCURRENT_SEARCHES, assignment="greedy", context=None, on_url=None):
+    semaphore = asyncio.Semaphore(max_concurrent_searches)
+    searches = {}
+
+    def get_search(query, page):
+        if (query, page) not in searches:
+            searches[(query, page)] = asyncio.ensure_future(
+                search_videos_async(client, semaphore, query, orientation_landscape=True, page=page, context=context))
+        return searches[(query, page)]
+
+    if assignment == "global":
+        # The solver needs every candidate first, so nothing is known before the end
+        timed_video_urls = await assign_video_urls_globally(get_search, timed_video_searches)
+        for item in timed_video_urls if on_url else ():
+            await on_url(item)
+        return timed_video_urls
+
+    # Every segment needs its first search, so start them all up front; later keywords and pages
+    # are only requested when selection reaches them, as in the sequential path
+    for _, search_terms in timed_video_searches:
+        if search_terms:
+            get_search(search_terms[0], 1)
+
+    # Selection walks the segments in order, exactly like generate_video_url, so used_links
+    # de-duplication picks the same clips for the same search results
+    timed_video_urls = []
+    used_links = set()
+    try:
+        for (t1, t2), search_terms in timed_video_searches:
+            url = None
+            for page in SEARCH_PAGES:
+                for query in search_terms:
+                    vids = await get_search(query, page)
+                    url = selectBestVideo(vids, query, orientation_landscape=True, used_vids=used_links)
+                    if url:
+                        used_links.add(get_video_key(url))
+                        break
+                if url:
+                    break
+            timed_video_urls.append([[t1, t2], url])
+            if on_url:
+                await on_url(timed_video_urls[-1])
+    finally:
+        pending = [search for search in searches.values() if not search.done()]
+        for search in pending:
+            search.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    return timed_video_urls
+
+async def assign_video_urls_globally(get_search, timed_video_searches):
+    assigned = {}
+    used_links = set()
+    pending = [i for i, (_, search_terms) in enumerate(timed_video_searches) if search_terms]
+
+    # Gather every pending segment's candidates for one page in a single batch, then solve them
+    # together; only segments left without a clip move on to the next page
+    for page in SEARCH_PAGES:
+        if not pending:
+            break
+        searches = {(query, page): get_search(query, page)
+                    for i in pending for query in timed_video_searches[i][1]}
+        await asyncio.gather(*searches.values())
+
+        segment_candidates = {}
+        for i in pending:
+            candidates = []
+            for keyword_rank, query in enumerate(timed_video_searches[i][1]):
+                for video, video_file in getCandidateFiles(searches[(query, page)].result()):
+                    link = video_file['link']
+                    candidates.append((get_video_key(link), link, score_candidate(video, keyword_rank, page)))
+            segment_candidates[i] = candidates
+
+        for i, link in solve_assignment(segment_candidates, used_links).items():
+            assigned[i] = link
+            used_links.add(get_video_key(link))
+        pending = [i for i in pending if i not in assigned]
+
+    for i in pending:
+        logging.warning(f"No suitable videos found for segment: {timed_video_searches[i][1]}")
+
+    return [[[t1, t2], assigned.get(i)] for i, ((t1, t2), _) in enumerate(timed_video_searches)]
@@ -0,0 +1,40 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+TARGET_DURATION = 15
+KEYWORD_RANK_WEIGHT = 5
+PAGE_WEIGHT = 5
+RESOLUTION_WEIGHT = 2
+# Stands in for "no edge" in the cost matrix; any pair at this cost is left unassigned
+UNASSIGNABLE_COST = 1e9
+
+def score_candidate(video, keyword_rank, page=1):
+    # Lower is better: the greedy duration heuristic, plus penalties for weaker keywords and later pages,
+    # minus a bonus for higher source resolution (capped at 4K)
+    duration_cost = abs(TARGET_DURATION - int(video['duration']))
+    resolution_bonus = RESOLUTION_WEIGHT * min(video['width'] / 1920, 2)
+    return duration_cost + KEYWORD_RANK_WEIGHT * keyword_rank + PAGE_WEIGHT * (page - 1) - resolution_bonus
+
+def solve_assignment(segment_candidates, excluded_keys=()):
+    # segment_candidates maps a segment id to (video_key, link, cost) tuples; each video key is used at most once
+    segments = [segment for segment, candidates in segment_candidates.items() if candidates]
+    key_index = {}
+    best = {}
+    for row, segment in enumerate(segments):
+        for key, link, cost in segment_candidates[segment]:
+            if key in excluded_keys:
+                continue
+            column = key_index.setdefault(key, len(key_index))
+            if (row, column) not in best or cost < best[(row, column)][0]:
+                best[(row, column)] = (cost, link)
+
+    if not best:
+        return {}
+
+    cost_matrix = np.full((len(segments), len(key_index)), UNASSIGNABLE_COST)
+    for (row, column), (cost, _) in best.items():
+        cost_matrix[row, column] = cost
+
+    rows, columns = linear_sum_assignment(cost_matrix)
+    return {segments[row]: best[(row, column)][1]
+            for row, column in zip(rows.tolist(), columns.tolist()) if (row, column) in best}
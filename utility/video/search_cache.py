@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from utility.utils import DIRECTORY_CACHE, ensure_directory_exists
+
+SEARCH_CACHE_PATH = os.path.join(DIRECTORY_CACHE, "pexels_search.sqlite3")
+SEARCH_CACHE_TTL = int(os.environ.get("PEXELS_CACHE_TTL", 7 * 24 * 3600))
+# Offline mode serves searches from the cache only and never touches the network
+PEXELS_OFFLINE = os.environ.get("PEXELS_OFFLINE", "") not in ("", "0", "false")
+
+_local = threading.local()
+
+def get_connection():
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        ensure_directory_exists(os.path.dirname(SEARCH_CACHE_PATH) or ".")
+        connection = sqlite3.connect(SEARCH_CACHE_PATH, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS searches (
+            cache_key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )""")
+        _local.connection = connection
+    return connection
+
+def normalize_query(query_string):
+    return " ".join(query_string.lower().split())
+
+def get_cache_key(params):
+    normalized = dict(params, query=normalize_query(params["query"]))
+    return json.dumps(normalized, sort_keys=True)
+
+def compact_response(json_data):
+    # Keep only the fields getBestVideo reads
+    return {
+        "videos": [
+            {
+                "id": video.get("id"),
+                "width": video["width"],
+                "height": video["height"],
+                "duration": video["duration"],
+                "video_files": [
+                    {"width": video_file["width"], "height": video_file["height"], "link": video_file["link"]}
+                    for video_file in video.get("video_files", [])
+                ]
+            }
+            for video in json_data.get("videos", [])
+        ]
+    }
+
+def get_cached_search(params, ttl=SEARCH_CACHE_TTL):
+    row = get_connection().execute(
+        "SELECT response, created_at FROM searches WHERE cache_key = ?", (get_cache_key(params),)
+    ).fetchone()
+    if row is None:
+        return None
+    response, created_at = row
+    # Stale entries are still good enough when offline
+    if not PEXELS_OFFLINE and time.time() - created_at > ttl:
+        return None
+    return json.loads(response)
+
+def store_search(params, json_data):
+    compact = compact_response(json_data)
+    try:
+        with get_connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO searches (cache_key, response, created_at) VALUES (?, ?, ?)",
+                (get_cache_key(params), json.dumps(compact), time.time())
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Error writing Pexels search cache: {str(e)}")
+    return compact
+
+def purge_expired(ttl=SEARCH_CACHE_TTL):
+    with get_connection() as connection:
+        return connection.execute("DELETE FROM searches WHERE created_at < ?", (time.time() - ttl,)).rowcount
@@ -1,9 +1,16 @@
 from openai import OpenAI
 import os
+import ast
 import json
+import math
 import re
+import tiktoken
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
 from utility.utils import log_response, LOG_TYPE_GPT
+from utility.script.llm_cache import cached_completion, LLMCacheMiss
 import logging
 
 if len(os.environ.get("GROQ_API_KEY", "")) > 30:
@@ -45,41 +52,203 @@ def fix_json(json_str):
     json_str = json_str.replace('\\"', '"')
     return json_str
 
-def getVideoSearchQueriesTimed(script, captions_timed):
+MAX_QUERY_ATTEMPTS = 2
+# Long-form requests are split into caption windows of about this many prompt tokens
+QUERY_WINDOW_TOKENS = int(os.environ.get("QUERY_WINDOW_TOKENS", 3000))
+QUERY_WINDOW_OVERLAP = 4
+MAX_CONCURRENT_QUERY_WINDOWS = int(os.environ.get("MAX_CONCURRENT_QUERY_WINDOWS", 4))
+CHARS_PER_TOKEN = 4
+FENCE_PATTERN = re.compile(r"```(?:json|python)?\s*(.*?)```", re.DOTALL)
+
+def normalize_response(text):
+    return re.sub(r'\s+', ' ', text.strip())
+
+def extract_list_text(content):
+    # Models wrap the list in ``` fences or in prose; keep the span from the first "[" to the last "]"
+    fenced = FENCE_PATTERN.search(content)
+    if fenced:
+        content = fenced.group(1)
+    start, end = content.find("["), content.rfind("]")
+    if start == -1 or end < start:
+        raise ValueError("No list found in API response")
+    return content[start:end + 1]
+
+def load_list_literal(text):
+    # The prompt's own example lists items without the outer brackets, so also try adding them
+    for candidate in (text, f"[{text}]"):
+        for loads in (json.loads, ast.literal_eval, lambda value: json.loads(fix_json(value))):
+            try:
+                out = loads(candidate)
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                continue
+            if isinstance(out, (list, tuple)) and out and all(isinstance(item, (list, tuple)) and len(item) == 2 for item in out):
+                return out
+    raise ValueError("Invalid format in API response")
+
+def parse_search_queries(content):
+    segments = []
+    for interval, keywords in load_list_literal(extract_list_text(content)):
+        try:
+            t1, t2 = (float(t) for t in interval)
+        except (TypeError, ValueError):
+            continue
+        if isinstance(keywords, str):
+            keywords = [keywords]
+        keywords = [str(keyword).strip() for keyword in keywords if str(keyword).strip()]
+        if keywords:
+            segments.append([[t1, t2], keywords])
+    if not segments:
+        raise ValueError("No usable segments in API response")
+    return segments
+
+def snap_to_captions(segments, captions_timed, start=0.0):
+    # Move every boundary onto the nearest caption boundary, then make the segments consecutive
+    # from start to the end of the last caption, so the model's rounding never costs another call
+    end = captions_timed[-1][0][1]
+    boundaries = sorted({start, end} | {float(t) for (t1, t2), _ in captions_timed for t in (t1, t2) if start <= t <= end})
+
+    def snap(t):
+        index = bisect_left(boundaries, t)
+        return min(boundaries[max(0, index - 1):index + 1], key=lambda boundary: abs(boundary - t))
+
+    snapped = []
+    position = start
+    for (t1, t2), keywords in sorted(segments, key=lambda segment: segment[0][0]):
+        # Gaps and overlaps both resolve to starting where the previous segment ended
+        t2 = snap(min(max(t1, t2), end))
+        if t2 <= position:
+            continue
+        snapped.append([[position, t2], keywords])
+        position = t2
+    if not snapped:
+        return None
+    snapped[-1][0][1] = end
+    return snapped
+
+def get_usable_segments(text, captions_timed, start=0.0):
+    # The check that decides a retry, shared with the LLM cache so it never stores an answer
+    # that would only be retried
+    try:
+        return snap_to_captions(parse_search_queries(normalize_response(text)), captions_timed, start)
+    except ValueError:
+        return None
+
+class ApproximateEncoding:
+    # Stands in when tiktoken cannot load its BPE file (it downloads it on first use)
+    def encode(self, text):
+        return range(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+@lru_cache(maxsize=None)
+def get_encoding():
     try:
-        content = call_OpenAI(script, captions_timed)
-        content = fix_json(content)
-        out = json.loads(content)
-        
-        if not isinstance(out, list) or not all(isinstance(item, list) and len(item) == 2 for item in out):
-            raise ValueError("Invalid format in API response")
-        
-        return out
-    except json.JSONDecodeError as e:
-        logging.error(f"JSON decoding error: {str(e)}")
-        logging.error(f"Problematic content: {content}")
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # tiktoken only knows OpenAI models; cl100k_base is close enough to size Llama prompts
+            return tiktoken.get_encoding("cl100k_base")
     except Exception as e:
-        logging.error(f"Error in getVideoSearchQueriesTimed: {str(e)}")
-    
+        logging.warning(f"Could not load a tiktoken encoding, estimating {CHARS_PER_TOKEN} characters per token: {str(e)}")
+        return ApproximateEncoding()
+
+def get_user_content(script, captions_timed):
+    return f"Script: {script}\nTimed Captions: {captions_timed}"
+
+def split_caption_windows(captions_timed, encoding, max_tokens=QUERY_WINDOW_TOKENS, overlap=QUERY_WINDOW_OVERLAP):
+    # Greedy (start, end) caption index ranges whose request stays under max_tokens. Neighbouring
+    # windows share `overlap` captions so the model sees the context on both sides of a cut.
+    # Each caption is counted twice: once in the window's script text, once in its timed list.
+    costs = [len(encoding.encode(caption[1])) + len(encoding.encode(repr(caption))) for caption in captions_timed]
+    windows = []
+    start = 0
+    while start < len(captions_timed):
+        end, tokens = start, 0
+        while end < len(captions_timed) and (end == start or tokens + costs[end] <= max_tokens):
+            tokens += costs[end]
+            end += 1
+        windows.append((start, end))
+        if end == len(captions_timed):
+            break
+        start = max(start + 1, end - overlap)
+    return windows
+
+def query_window(script, captions_timed, context=None, start=0.0):
+    # One round-trip in the common case: the parser tolerates the usual formatting slips and the
+    # intervals are repaired locally; only an unusable answer is retried, and at most once
+    for attempt in range(MAX_QUERY_ATTEMPTS):
+        content = None
+        try:
+            content = call_OpenAI(script, captions_timed, context, start)
+            segments = snap_to_captions(parse_search_queries(content), captions_timed, start)
+            if segments:
+                return segments
+            logging.error("No usable segments after snapping to captions")
+        except ValueError as e:
+            logging.error(f"Could not parse search queries (attempt {attempt + 1}/{MAX_QUERY_ATTEMPTS}): {str(e)}")
+            logging.error(f"Problematic content: {content}")
+        except LLMCacheMiss as e:
+            # Replay mode answers the same way every time
+            logging.error(f"Error in getVideoSearchQueriesTimed: {str(e)}")
+            return None
+        except Exception as e:
+            logging.error(f"Error in getVideoSearchQueriesTimed (attempt {attempt + 1}/{MAX_QUERY_ATTEMPTS}): {str(e)}")
+
     return None
 
-def call_OpenAI(script, captions_timed):
-    user_content = f"Script: {script}\nTimed Captions: {captions_timed}"
+def merge_windows(captions_timed, windows, window_segments):
+    # Each window owns the stretch up to the middle of its overlap with the next one; its segments
+    # are clipped to that stretch, and the cuts sit on caption starts, which are snapped boundaries
+    cuts = [0.0]
+    for (_, end), (next_start, _) in zip(windows, windows[1:]):
+        cuts.append(float(captions_timed[(next_start + end) // 2][0][0]))
+    cuts.append(captions_timed[-1][0][1])
+
+    merged = []
+    for (cut_start, cut_end), segments in zip(zip(cuts, cuts[1:]), window_segments):
+        for (t1, t2), keywords in segments:
+            t1, t2 = max(t1, cut_start), min(t2, cut_end)
+            if t2 > t1:
+                merged.append([[t1, t2], keywords])
+    return snap_to_captions(merged, captions_timed)
+
+def getVideoSearchQueriesTimed(script, captions_timed, context=None):
+    # A token is at least one character, so a request this short never needs the tokenizer
+    user_content = get_user_content(script, captions_timed)
+    if len(user_content) <= QUERY_WINDOW_TOKENS:
+        return query_window(script, captions_timed, context)
+    encoding = get_encoding()
+    if len(encoding.encode(user_content)) <= QUERY_WINDOW_TOKENS:
+        return query_window(script, captions_timed, context)
+
+    # Long scripts: ask for each window of the caption timeline concurrently, sending only the
+    # captions' text as its script, then stitch the answers into one continuous list
+    windows = split_caption_windows(captions_timed, encoding)
+    logging.info(f"Generating search queries in {len(windows)} windows of up to {QUERY_WINDOW_TOKENS} tokens")
+
+    def query(window):
+        start, end = window
+        window_captions = captions_timed[start:end]
+        window_script = " ".join(text for _, text in window_captions)
+        window_start = 0.0 if start == 0 else float(window_captions[0][0][0])
+        return query_window(window_script, window_captions, context, window_start)
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_QUERY_WINDOWS) as executor:
+        window_segments = list(executor.map(query, windows))
+    if any(segments is None for segments in window_segments):
+        logging.error("Search query generation failed for at least one window")
+        return None
+    return merge_windows(captions_timed, windows, window_segments)
+
+def call_OpenAI(script, captions_timed, context=None, start=0.0):
+    user_content = get_user_content(script, captions_timed)
     logging.info(f"Sending request to OpenAI API with content length: {len(user_content)}")
     
     try:
-        response = client.chat.completions.create(
-            model=model,
-            temperature=1,
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": user_content}
-            ]
-        )
-        
-        text = response.choices[0].message.content.strip()
-        text = re.sub('\s+', ' ', text)
-        log_response(LOG_TYPE_GPT, script, text)
+        # Cached on the full request; logs imported into the cache are matched on the script alone.
+        # Answers without usable segments are not cached, so a retry asks the model again.
+        text = cached_completion(client, model, prompt, user_content, temperature=1, seed=script,
+                                 validate=lambda content: get_usable_segments(content, captions_timed, start) is not None)
+        text = normalize_response(text)
+        log_response(LOG_TYPE_GPT, script, text, context)
         return text
     except Exception as e:
         logging.error(f"Error calling OpenAI API: {str(e)}")
@@ -0,0 +1,113 @@
+import os
+import json
+import socket
+import asyncio
+import argparse
+import logging
+import threading
+from batch import read_jobs
+from utility.pipeline.checkpoint import PIPELINE_STAGES
+from utility.pipeline.pipeline import PipelineRun
+from utility.pipeline.work_queue import WorkQueue, WORK_QUEUE_PATH, LEASE_SECONDS
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+POLL_INTERVAL = 5
+
+class Heartbeat(threading.Thread):
+    # Renews the lease from its own thread and connection, because stages such as rendering and
+    # Whisper block the worker's event loop for their whole run
+
+    def __init__(self, queue_path, task, worker_id):
+        super().__init__(daemon=True)
+        self.queue_path = queue_path
+        self.task = task
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        queue = WorkQueue(self.queue_path)
+        while not self.stopped.wait(LEASE_SECONDS / 3):
+            if not queue.heartbeat(self.task, self.worker_id):
+                logging.warning(f"Lost the lease on stage '{self.task['stage']}' of job {self.task['job_id']}")
+                self.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+async def run_task(queue, queue_path, task, worker_id):
+    logging.info(f"Running stage '{task['stage']}' of job {task['job_id']} (attempt {task['attempt']})")
+    heartbeat = Heartbeat(queue_path, task, worker_id)
+    heartbeat.start()
+    try:
+        output = await PipelineRun(task["spec"]).run_stage(task["stage"])
+        error = None if output is not None else f"Stage '{task['stage']}' produced no output"
+    except Exception as e:
+        error = str(e)
+    finally:
+        heartbeat.stop()
+
+    if heartbeat.lost:
+        # Another worker owns the stage now; whatever we produced is already in the job's manifests
+        return
+    if error is None:
+        queue.complete(task, worker_id)
+    elif queue.fail(task, worker_id, error):
+        logging.warning(f"Stage '{task['stage']}' of job {task['job_id']} failed, will retry: {error}")
+    else:
+        logging.error(f"Stage '{task['stage']}' of job {task['job_id']} failed for good: {error}")
+
+async def work(queue_path, stages, worker_id, once=False):
+    queue = WorkQueue(queue_path)
+    logging.info(f"Worker {worker_id} claiming stages: {', '.join(stages)}")
+    while True:
+        task = queue.claim(worker_id, stages)
+        if task is None:
+            if once:
+                return
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+        await run_task(queue, queue_path, task, worker_id)
+
+def parse_stages(value):
+    stages = [stage.strip() for stage in value.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in PIPELINE_STAGES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown stages: {', '.join(unknown)} (choose from {', '.join(PIPELINE_STAGES)})")
+    return stages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run pipeline stages from a durable work queue shared between machines.")
+    parser.add_argument("--queue", type=str, default=WORK_QUEUE_PATH, help="Path of the SQLite work queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = commands.add_parser("submit", help="Queue every job in a JSONL file")
+    submit_parser.add_argument("jobs_file", type=str, help="JSONL file with one job per line, as for batch.py")
+
+    work_parser = commands.add_parser("work", help="Claim and run stages until stopped")
+    work_parser.add_argument("--stages", type=parse_stages, default=PIPELINE_STAGES, help="Comma-separated stages this worker runs (default: all)")
+    work_parser.add_argument("--worker_id", type=str, default=f"{socket.gethostname()}-{os.getpid()}", help="Name recorded on leases")
+    work_parser.add_argument("--once", action="store_true", help="Exit when no claimable stage is left instead of polling")
+
+    status_parser = commands.add_parser("status", help="Show stage counts, or one job's stages")
+    status_parser.add_argument("job_id", type=str, nargs="?", help="Job to describe")
+
+    args = parser.parse_args()
+    if args.command == "submit":
+        queue = WorkQueue(args.queue)
+        jobs = read_jobs(args.jobs_file)
+        for job in jobs:
+            queue.submit(job)
+        logging.info(f"Queued {len(jobs)} jobs in {args.queue}")
+    elif args.command == "work":
+        asyncio.run(work(args.queue, args.stages, args.worker_id, args.once))
+    elif args.command == "status":
+        queue = WorkQueue(args.queue)
+        if args.job_id:
+            print(json.dumps(queue.job_status(args.job_id), indent=2))
+        else:
+            for stage, status, count in queue.summary():
+                print(f"{stage:<16}{status:<10}{count}")